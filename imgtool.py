@@ -1,21 +1,38 @@
 #!/usr/bin/env python3
 
 import logging
+import mmap
+import re
 import sqlite3
-
-from argparse import ArgumentParser
-from ast import literal_eval
-from base64 import b64encode, b64decode
-from hashlib import md5
+import sys
+
+from argparse import ArgumentParser, ArgumentTypeError
+from atexit import register as atexit_register
+from base64 import b64decode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextlib import redirect_stderr, redirect_stdout
+from itertools import groupby
+from functools import partial
+from hashlib import md5, new as new_hash
+from io import StringIO
 from json import dumps as json_dump
-from os import environ as env
-from os.path import isfile
-from os.path import abspath, basename
-from pathlib import Path
-from rich.progress import track
-from shutil import which
-from subprocess import run
-from sys import exit
+from json import loads as json_load
+from os import cpu_count, environ as env
+from os import read as os_read
+from os import close as os_close
+from os import chmod, fsync, remove, scandir, stat
+from os.path import exists, isfile
+from os.path import abspath, basename, dirname
+from select import POLLIN, poll
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from queue import Queue
+from signal import SIGTERM, signal
+from struct import Struct
+from sys import argv, exit
+from threading import Lock, Thread
+from time import monotonic, perf_counter, thread_time
 
 
 class ExifToolMissing(Exception):
@@ -24,21 +41,82 @@ class ExifToolMissing(Exception):
         super().__init__(self.message)
 
 
-EXIFTOOL_CMD = which("exiftool")
-if not EXIFTOOL_CMD:
-    raise ExifToolMissing
+# IMGTOOL_EXIFTOOL overrides the exiftool found on the PATH
+EXIFTOOL_CMD = None
+
+
+def exiftool_command():
+    """
+    Returns the exiftool executable, it is only looked up once a subcommand
+    needs it. Raises ExifToolMissing when it is not installed.
+    """
+    from shutil import which
+
+    global EXIFTOOL_CMD
+    if EXIFTOOL_CMD is None:
+        EXIFTOOL_CMD = env.get("IMGTOOL_EXIFTOOL") or which("exiftool")
+        if not EXIFTOOL_CMD:
+            raise ExifToolMissing
+    return EXIFTOOL_CMD
+
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Number of long-running exiftool processes, defaults to the number of cores
+EXIFTOOL_POOL_SIZE = int(env.get("IMGTOOL_EXIFTOOL_WORKERS", 0)) or cpu_count() or 1
+
 IMAGE_DATA_ROWS = [
     "name",
     "exifdata_checksum",
     "imagedata_checksum",
     "exifdata_encoded",
     "path",
+    "size",
+    "mtime_ns",
+    "inode",
+    "dev",
+    "phash",
+    "payload_size",
+    "partial_checksum",
 ]
 
+# Columns that make up the stat fingerprint used to detect changed files
+FINGERPRINT_ROWS = ["size", "mtime_ns", "inode", "dev"]
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".heic")
+VIDEO_EXTENSIONS = (".mp4", ".mov")
+MEDIA_EXTENSIONS = IMAGE_EXTENSIONS + VIDEO_EXTENSIONS
+
+# Storage formats of the exifdata_encoded column
+# 1: base64 encoded repr() of the exifdata dict
+# 2: compact JSON object, can be queried with the SQLite JSON functions
+EXIFDATA_FORMAT_LEGACY = 1
+EXIFDATA_FORMAT_JSON = 2
+
+# Files and exiftool output are hashed in chunks of this size
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Number of bytes hashed at the start and at the end of the payload for
+# the partial checksum of the tiered index mode
+PARTIAL_SAMPLE_SIZE = 64 * 1024
+
+# Digest algorithms that can be used for the imagedata checksum of a database
+DIGEST_ALGORITHMS = ("md5", "blake2b", "sha256")
+DEFAULT_DIGEST = "md5"
+
+# Pending rows are committed every DB_BATCH_SIZE rows or DB_BATCH_INTERVAL seconds
+DB_BATCH_SIZE = 500
+DB_BATCH_INTERVAL = 2.0
+
+# Connection tuning, the page cache is per connection and mmap_size is an upper bound
+DB_CACHE_SIZE = 64 * 1024 * 1024
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+# Hashes per side of a tile the numpy engine compares at once, a 256 x 256
+# tile of uint64 distances is 512 KiB and stays in the L2 cache
+SIMILAR_BLOCK_SIZE = 256
+
 
 VALID_SOFTWARE_TAG_VALUES = [
     "1.0300",
@@ -163,423 +241,3181 @@ INVALID_SOFTWARE_TAG_VALUES = [
 ]
 
 
-class ImageData(object):
+class Profiler(object):
     """
-    Defines an image object. It contains all the attributes we want to query for deduplication
+    Accumulates the wall and CPU time spent in named stages and counts
+    events such as started subprocesses, bytes read and rows written.
+    CPU time is measured per thread, so stages that run in parallel threads
+    do not count each other's work.
     """
 
-    def __init__(self, path):
-        self.name = basename(path)
-        self.path = abspath(path)
-        self.imagedata_checksum = None
-        self.exifdata_checksum = None
-        self.exifdata = {}
-        self.calculate_imagedata_checksum()
-        self.parse_exifdata()
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = {}
+        self.counters = {}
+        self.started = (perf_counter(), getrusage(RUSAGE_SELF))
 
-    def parse_exifdata(self):
-        """
-        Creates a checksum of only the image exif data
-        It excludes a bunch of field that are always different
-        Such as creation, modification or access times
-        """
-        _cmd = [
-            EXIFTOOL_CMD,
-            self.path,
-            "-x",
-            "Directory",
-            "-x",
-            "FileName",
-            "-x",
-            "FilePermissions",
-            "-x",
-            "FileAccessDate",
-            "-x",
-            "FileModifyDate",
-            "-x",
-            "FileInodeChangeDate",
-            "-x",
-            "ExifToolVersion",
-        ]
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = perf_counter(), thread_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, 1, perf_counter() - wall, thread_time() - cpu)
+
+    def add_stage(self, name, calls, wall, cpu):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += calls
+            stage[1] += wall
+            stage[2] += cpu
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def take(self):
+        """Returns the stages and counters recorded so far and resets them"""
+        with self.lock:
+            taken = (self.stages, self.counters)
+            self.stages, self.counters = {}, {}
+        return taken
+
+    def merge(self, taken):
+        """Adds stages and counters taken from a profiler in another process"""
+        stages, counters = taken
+        for name, stage in stages.items():
+            self.add_stage(name, *stage)
+        for name, n in counters.items():
+            self.count(name, n)
+
+    def report(self):
+        wall, usage = self.started
+        now = getrusage(RUSAGE_SELF)
+        children = getrusage(RUSAGE_CHILDREN)
+        return {
+            "wall_s": perf_counter() - wall,
+            "cpu_s": now.ru_utime + now.ru_stime - usage.ru_utime - usage.ru_stime,
+            "children_cpu_s": children.ru_utime + children.ru_stime,
+            "max_rss_kib": now.ru_maxrss,
+            "stages": {
+                name: {"calls": calls, "wall_s": wall, "cpu_s": cpu}
+                for name, (calls, wall, cpu) in sorted(self.stages.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+
+# Set by --profile, everything below only records into it when it is set
+PROFILER = None
+
+
+def profile_stage(name):
+    """Returns a context manager that records its block as stage name"""
+    return PROFILER.stage(name) if PROFILER else nullcontext()
+
+
+def profile_count(name, n=1):
+    if PROFILER:
+        PROFILER.count(name, n)
+
+
+def profiled_call(fn, item):
+    """
+    Calls fn in a worker process and returns its result together with the
+    stages and counters the worker recorded, see worker_results
+    """
+    result = fn(item)
+    return result, PROFILER.take() if PROFILER else None
 
-        result = run(_cmd, capture_output=True)
 
-        # parse stdout to mapping
-        _exifdata = {}
-        for line in result.stdout.decode("cp850").split("\n"):
-            if not line:
-                continue
-            separator_index = line.index(":")
-            k = line[:separator_index].rstrip(" ")
-            v = line[separator_index + 2 :].lstrip(" ")
-            _exifdata.update({k: v})
+def worker_results(results):
+    """Merges the profiles returned by profiled_call and yields the results"""
+    for result, taken in results:
+        if taken:
+            PROFILER.merge(taken)
+        yield result
 
-        self.exifdata = dict(sorted(_exifdata.items()))
-        self.exifdata_checksum = md5(str(self.exifdata).encode()).hexdigest()
 
-    def calculate_imagedata_checksum(self):
-        """
-        Creates a checksum of the image data without including exif data
-        """
-        _cmd = [
-            EXIFTOOL_CMD,
-            self.path,
-            "-all=",
-            "-o",
-            "-",
-            "-b",
-        ]
+class ExifToolError(Exception):
+    def __init__(self, message="Exiftool process exited unexpectedly"):
+        self.message = message
+        super().__init__(self.message)
 
-        result = run(_cmd, capture_output=True)
 
-        self.imagedata_checksum = md5(result.stdout).hexdigest()
+class ExifToolTimeout(ExifToolError):
+    pass
 
 
-class ImageDataDB(object):
+class ExifToolFrame(object):
     """
-    Implements database operations for image data
+    A single command of a "-stay_open" exiftool process and its response
+
+    Both process classes frame commands with this, they only differ in how
+    they write the command and read the chunks passed to feed().
     """
 
-    def __init__(self, sqlite_db_path):
-        self.db = abspath(sqlite_db_path)
-        self.connection = sqlite3.connect(self.db)
-        self.cursor = self.connection.cursor()
-        self.initialize_database()
+    def __init__(self, args, sequence, sink=None):
+        self.command = "\n".join(list(args) + [f"-execute{sequence}", ""]).encode()
+        self.marker = f"{{ready{sequence}}}\n".encode()
+        self.sink = sink
+        self.output = bytearray()
+
+    def feed(self, chunk):
+        """Adds a chunk read from stdout, returns True once the marker was read"""
+        if not chunk:
+            raise ExifToolError()
+        self.output += chunk
+
+        # hold back enough bytes to recognize a marker split across reads
+        if self.sink and len(self.output) > HASH_CHUNK_SIZE:
+            self.sink(bytes(self.output[: -len(self.marker)]))
+            del self.output[: -len(self.marker)]
+        return self.output.endswith(self.marker)
+
+    def result(self):
+        """Returns the output without the marker, or passes its rest to sink"""
+        output = bytes(self.output[: -len(self.marker)])
+        if self.sink:
+            self.sink(output)
+            return b""
+        return output
+
+
+class ExifToolProcess(object):
+    """
+    A single exiftool process running in "-stay_open True -@ -" mode
 
-    def initialize_database(self):
-        logger.debug("Create image_table data if it does not exist")
-        self.cursor.execute(
-            f"CREATE TABLE IF NOT EXISTS image_data({','.join(IMAGE_DATA_ROWS)})"
-        )
+    Commands are written to stdin one argument per line and terminated
+    with "-execute<N>". The output of each command on stdout is terminated
+    by a "{ready<N>}" marker, which is how responses are framed.
+    """
 
-        logger.debug(
-            'Create index for "imagedata_checksum" column on the image_data table'
-        )
-        self.cursor.execute(
-            "CREATE INDEX IF NOT EXISTS imagedata_checksum ON image_data(imagedata_checksum)"
+    def __init__(self):
+        self.process = None
+        self.sequence = 0
+        self.start()
+
+    def start(self):
+        from subprocess import DEVNULL, PIPE, Popen
+
+        logger.debug("Starting persistent exiftool process")
+        profile_count("subprocesses")
+        self.process = Popen(
+            [exiftool_command(), "-stay_open", "True", "-@", "-"],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=DEVNULL,
         )
 
-        logger.debug(
-            'Create index for "exifdata_checksum" column on the image_data table'
-        )
-        self.cursor.execute(
-            "CREATE INDEX IF NOT EXISTS exifdata_checksum ON image_data(exifdata_checksum)"
-        )
+    def restart(self):
+        self.terminate()
+        self.start()
 
-        logger.debug(
-            'Create compound index for the "imagedata_checksum" and "exifdata_checksum" columns on the image_data table'
-        )
-        self.cursor.execute(
-            "CREATE INDEX IF NOT EXISTS checksums ON image_data(imagedata_checksum, exifdata_checksum)"
-        )
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
 
-    def insert(self, image_data):
+    def execute(self, args, sink=None):
         """
-        insert a single image_data object as one row
+        Run exiftool with args and return everything it wrote to stdout
+        When sink is given, stdout is passed to it in chunks as it is read
+        instead, so the output is never held in memory as a whole
         """
-        self.cursor.execute(f"""
-            INSERT INTO image_data VALUES
-            (
-                '{escape_query_string(image_data.name)}',
-                '{image_data.exifdata_checksum}',
-                '{image_data.imagedata_checksum}',
-                '{b64encode(str(image_data.exifdata).encode()).decode()}',
-                '{escape_query_string(image_data.path)}'
-            )
-        """)
-        self.connection.commit()
+        self.sequence += 1
+        frame = ExifToolFrame(args, self.sequence, sink)
 
-    def remove_by_path(self, path):
-        self.cursor.execute(
-            f"DELETE FROM image_data WHERE path = '{escape_query_string(path)}'"
-        )
-        self.connection.commit()
+        try:
+            self.process.stdin.write(frame.command)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise ExifToolError(f"Could not write to exiftool process: {e}")
+
+        fd = self.process.stdout.fileno()
+        while not frame.feed(os_read(fd, HASH_CHUNK_SIZE)):
+            pass
+        return frame.result()
+
+    def terminate(self):
+        if not self.alive():
+            return
+        try:
+            self.process.stdin.write(b"-stay_open\nFalse\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
 
-    def select_all(self):
-        res = self.cursor.execute("SELECT * FROM image_data")
-        return res.fetchall()
 
-    def select_by_path(self, path):
-        res = self.cursor.execute(f"""
-            SELECT * FROM image_data WHERE path = '{escape_query_string(abspath(path))}'
-        """)
-        return res.fetchall()
+class ExifToolPool(object):
+    """
+    A pool of persistent exiftool processes that can be shared between threads
 
-    def path_exists(self, path):
-        res = self.cursor.execute(
-            f"SELECT * FROM image_data WHERE path = '{escape_query_string(abspath(path))}'"
+    Processes are started lazily, up to size, and restarted when they crash.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or EXIFTOOL_POOL_SIZE
+        self.started = 0
+        self.processes = []
+        self.idle = Queue()
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and self.started < self.size:
+                self.started += 1
+                process = ExifToolProcess()
+                self.processes.append(process)
+                return process
+        return self.idle.get()
+
+    def release(self, process):
+        self.idle.put(process)
+
+    def execute(self, args, sink=None, retries=1):
+        """
+        Run a single exiftool command on one of the pooled processes
+        A crashed process is restarted and the command is retried, unless
+        part of the output was already passed to sink
+        """
+        process = self.acquire()
+        try:
+            while True:
+                try:
+                    return process.execute(args, sink)
+                except ExifToolError as e:
+                    logger.warning(f"Restarting exiftool process: {e.message}")
+                    process.restart()
+                    if retries <= 0 or sink:
+                        raise e
+                    retries -= 1
+        finally:
+            self.release(process)
+
+    def close(self):
+        with self.lock:
+            for process in self.processes:
+                process.terminate()
+            self.processes = []
+            self.started = 0
+            self.idle = Queue()
+
+
+class AsyncExifToolProcess(object):
+    """
+    The asyncio counterpart of ExifToolProcess, it has to be used from
+    the event loop it was started in
+    """
+
+    def __init__(self):
+        self.process = None
+        self.sequence = 0
+
+    async def start(self):
+        import asyncio
+        from subprocess import DEVNULL, PIPE
+
+        logger.debug("Starting persistent exiftool process")
+        profile_count("subprocesses")
+        self.process = await asyncio.create_subprocess_exec(
+            exiftool_command(),
+            "-stay_open",
+            "True",
+            "-@",
+            "-",
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=DEVNULL,
         )
-        return res.fetchone() is not None
 
-    def dump(self):
-        return list(map(lambda r: dict(zip(IMAGE_DATA_ROWS, r)), self.select_all()))
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def execute(self, args, sink=None):
+        """Like ExifToolProcess.execute, but other commands run while it waits"""
+        self.sequence += 1
+        frame = ExifToolFrame(args, self.sequence, sink)
+
+        try:
+            self.process.stdin.write(frame.command)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError, OSError) as e:
+            raise ExifToolError(f"Could not write to exiftool process: {e}")
+
+        while not frame.feed(await self.process.stdout.read(HASH_CHUNK_SIZE)):
+            pass
+        return frame.result()
 
+    def kill(self):
+        if self.alive():
+            self.process.kill()
 
-def get_image_sets(db):
-    """Returns two dictionaries of images sorted by imagedata_checksum (as the key)
-    The first dictionary contains only images with duplicates while the second
-    contains all images
+    async def terminate(self):
+        import asyncio
+
+        if not self.alive():
+            return
+        try:
+            self.process.stdin.write(b"-stay_open\nFalse\n")
+            await self.process.stdin.drain()
+            await asyncio.wait_for(self.process.wait(), 5)
+        except Exception:
+            self.kill()
+            await self.process.wait()
+
+
+class AsyncExifToolPool(object):
     """
-    rows = db.dump()
+    Runs exiftool commands on persistent processes from an asyncio event loop
 
-    all_sets = {}
-    for row in rows:
-        all_sets.setdefault(row["imagedata_checksum"], []).append(row)
+    A semaphore keeps at most size commands in flight, every process runs
+    one command at a time and processes are started lazily. A command that
+    takes longer than timeout seconds, or whose task is cancelled, leaves
+    its process in an unknown state, so that process is killed and a new
+    one is started for the next command.
+
+    The event loop runs in a background thread. Coroutines await run, while
+    synchronous callers such as the worker threads of index and fix use
+    execute, the same interface as ExifToolPool.
+    """
+
+    def __init__(self, size=None, timeout=None):
+        import asyncio
+
+        self.size = size or EXIFTOOL_POOL_SIZE
+        self.timeout = timeout
+        self.idle = []
+        self.processes = set()
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(self.size)
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def acquire(self):
+        if self.idle:
+            return self.idle.pop()
+        process = AsyncExifToolProcess()
+        await process.start()
+        self.processes.add(process)
+        return process
+
+    def discard(self, process):
+        process.kill()
+        self.processes.discard(process)
+
+    async def run(self, args, sink=None):
+        """Run a single exiftool command on one of the pooled processes"""
+        import asyncio
+
+        async with self.semaphore:
+            process = await self.acquire()
+            try:
+                output = await asyncio.wait_for(
+                    process.execute(args, sink), self.timeout
+                )
+            except asyncio.TimeoutError:
+                self.discard(process)
+                raise ExifToolTimeout(f"Timed out after {self.timeout}s: {args}")
+            except BaseException:
+                self.discard(process)
+                raise
+            self.idle.append(process)
+            return output
+
+    def execute(self, args, sink=None, retries=1):
+        """
+        Run a command from a thread other than the event loop and wait for
+        it. A crashed process is replaced and the command is retried, unless
+        it timed out or part of the output was already passed to sink.
+        """
+        import asyncio
 
-    duplicate_sets = {k: v for k, v in all_sets.items() if len(v) > 1}
+        while True:
+            future = asyncio.run_coroutine_threadsafe(self.run(args, sink), self.loop)
+            try:
+                return future.result()
+            except ExifToolTimeout:
+                raise
+            except ExifToolError as e:
+                logger.warning(f"Restarting exiftool process: {e.message}")
+                if retries <= 0 or sink:
+                    raise e
+                retries -= 1
+            except BaseException:
+                future.cancel()
+                raise
+
+    def close(self):
+        import asyncio
+
+        if self.loop.is_closed():
+            return
+
+        async def shutdown():
+            await asyncio.gather(*(p.terminate() for p in self.processes))
+            self.processes = set()
+            self.idle = []
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+EXIFTOOL_POOL = None
+# Threads that run their first exiftool command at the same time would each
+# create a pool of their own otherwise
+EXIFTOOL_POOL_LOCK = Lock()
+
+
+def use_async_exiftool(size=None, timeout=None):
+    """Makes the async engine the process-wide exiftool pool"""
+    global EXIFTOOL_POOL
+    EXIFTOOL_POOL = AsyncExifToolPool(size, timeout)
+    atexit_register(EXIFTOOL_POOL.close)
+
+
+def get_exiftool_pool():
+    """Returns the process-wide exiftool pool, it is created on first use"""
+    global EXIFTOOL_POOL
+    if EXIFTOOL_POOL is None:
+        with EXIFTOOL_POOL_LOCK:
+            if EXIFTOOL_POOL is None:
+                EXIFTOOL_POOL = ExifToolPool()
+                atexit_register(EXIFTOOL_POOL.close)
+    return EXIFTOOL_POOL
+
+
+def exiftool(args, sink=None):
+    """Run an exiftool command through the pool and return stdout"""
+    if not PROFILER:
+        return get_exiftool_pool().execute(args, sink)
+
+    PROFILER.count("exiftool_commands")
+    with PROFILER.stage("exiftool"):
+        if sink:
+            output_sink = sink
+
+            def sink(chunk):
+                PROFILER.count("exiftool_bytes", len(chunk))
+                output_sink(chunk)
+
+        output = get_exiftool_pool().execute(args, sink)
+    PROFILER.count("exiftool_bytes", len(output))
+    return output
+
+
+class UnsupportedFormat(Exception):
+    def __init__(self, message="File format can not be parsed natively"):
+        self.message = message
+        super().__init__(self.message)
 
-    return duplicate_sets, all_sets
 
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
 
-def decode_exifdata(encoded_string):
-    return literal_eval(b64decode(encoded_string).decode())
+# Any marker that can end entropy-coded data, stuffed bytes (0xFF00),
+# restart markers (0xFFD0-0xFFD7) and fill bytes (0xFFFF) are skipped
+JPEG_MARKER = re.compile(rb"\xff[\x01-\xcf\xd8-\xfe]")
 
 
-# TODO: needs improvement
-def escape_query_string(string):
-    return string.replace("'", "''")
+def merge_ranges(ranges):
+    """Merge adjacent (start, end) byte ranges"""
+    merged = []
+    for start, end in ranges:
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
 
 
-def find_images(path):
+def jpeg_payload_ranges(data):
     """
-    Recursively find jpg and jpeg images on the specified path
+    Returns the byte ranges of a JPEG file that "exiftool -all=" keeps
+
+    APPn and COM segments are skipped, except for the Adobe APP14 segment
+    which exiftool does not remove because it affects how the image is
+    decoded. Frame, table and scan segments and the entropy-coded data
+    are kept. Everything after the EOI marker (trailers) is dropped.
     """
-    # the question mark matches a single chacter, the p is not optional
-    jpgs = list(Path(abspath(path)).rglob("**/*.jpg"))
-    jpegs = list(Path(abspath(path)).rglob("**/*.jpeg"))
-    heics = list(Path(abspath(path)).rglob("**/*.heic"))
-    return sorted(jpgs + jpegs + heics)
+    size = len(data)
+    if data[:2] != b"\xff\xd8":
+        raise UnsupportedFormat("Missing JPEG SOI marker")
+
+    ranges = [(0, 2)]
+    pos = 2
+    while True:
+        if pos + 2 > size or data[pos] != 0xFF:
+            raise UnsupportedFormat(f"Expected a JPEG marker at offset {pos}")
+
+        marker = data[pos + 1]
+        if marker == 0xD9:  # EOI
+            ranges.append((pos, pos + 2))
+            return merge_ranges(ranges)
+
+        if pos + 4 > size or marker in (0x01, 0xFF) or 0xD0 <= marker <= 0xD8:
+            raise UnsupportedFormat(f"Unexpected JPEG marker at offset {pos}")
+
+        length = int.from_bytes(data[pos + 2 : pos + 4], "big")
+        end = pos + 2 + length
+        if length < 2 or end > size:
+            raise UnsupportedFormat(f"Truncated JPEG segment at offset {pos}")
+
+        if marker == 0xDA:  # SOS, the entropy-coded data follows the header
+            match = JPEG_MARKER.search(data, end)
+            if not match:
+                raise UnsupportedFormat("Missing JPEG EOI marker")
+            ranges.append((pos, match.start()))
+            pos = match.start()
+            continue
+
+        is_adobe = marker == 0xEE and data[pos + 4 : pos + 9] == b"Adobe"
+        if not (0xE0 <= marker <= 0xEF or marker == 0xFE) or is_adobe:
+            ranges.append((pos, end))
+        pos = end
+
 
+def hash_ranges(data, ranges, digest):
+    """Feed the byte ranges of data to digest in fixed-size chunks"""
+    profile_count("bytes_read", sum(end - start for start, end in ranges))
+    view = memoryview(data)
+    try:
+        with profile_stage("hash"):
+            for start, end in ranges:
+                for offset in range(start, end, HASH_CHUNK_SIZE):
+                    digest.update(view[offset : min(offset + HASH_CHUNK_SIZE, end)])
+    finally:
+        view.release()
+    return digest
 
-def index_media(db, path, force_reindex):
+
+def read_uint(data, offset, size):
+    """Reads a big-endian unsigned integer of size bytes at offset"""
+    if offset + size > len(data):
+        raise UnsupportedFormat(f"Unexpected end of data at offset {offset}")
+    return int.from_bytes(data[offset : offset + size], "big")
+
+
+def iter_boxes(data, start, end):
     """
-    When called all files at path will be indexed into the database
+    Yields (type, payload_start, payload_end) for the ISOBMFF boxes
+    between start and end
     """
-    logger.info(f'Searching for files in "{path}"')
-    files = find_images(path) += find_videos(path)
-
-    logger.info(f"Staring file index on {len(files)} files")
-    for f in track(files, description="Indexing files..."):
-        # skip files we have already indexed
-        if db.path_exists(f) and not force_reindex:
-            logger.debug(f'Skipping file "{f}"')
+    pos = start
+    while pos + 8 <= end:
+        size = read_uint(data, pos, 4)
+        box_type = bytes(data[pos + 4 : pos + 8])
+        header = 8
+        if size == 1:
+            size = read_uint(data, pos + 8, 8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+
+        if size < header or pos + size > end:
+            raise UnsupportedFormat(f"Invalid {box_type!r} box at offset {pos}")
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def find_box(data, start, end, box_type):
+    """Returns (payload_start, payload_end) of the first box_type box or None"""
+    for _type, payload_start, payload_end in iter_boxes(data, start, end):
+        if _type == box_type:
+            return payload_start, payload_end
+    return None
+
+
+def heif_item_types(data, start, end):
+    """Returns a mapping of item id to item type from an iinf box"""
+    version = data[start]
+    pos = start + 4 + (2 if version == 0 else 4)
+
+    item_types = {}
+    for box_type, payload_start, _ in iter_boxes(data, pos, end):
+        if box_type != b"infe" or data[payload_start] < 2:
             continue
+        id_size = 2 if data[payload_start] == 2 else 4
+        item_id = read_uint(data, payload_start + 4, id_size)
+        type_offset = payload_start + 4 + id_size + 2
+        item_types[item_id] = bytes(data[type_offset : type_offset + 4])
+    return item_types
 
-        try:
-            logger.debug(f'Parsing file "{f}"')
-            image_data = ImageData(f)
 
-            logger.debug(f'Inserting file "{f}"')
-            db.insert(image_data)
-        except Exception as e:
-            logger.error(f'Error occurred while parsing file "{f}"')
-            raise e
+def heif_item_ranges(data, start, end, idat):
+    """
+    Returns a mapping of item id to the byte ranges of its data from an
+    iloc box. idat is the (start, end) of the idat box payload or None.
+    """
+    version = data[start]
+    pos = start + 4
+    offset_size = data[pos] >> 4
+    length_size = data[pos] & 0x0F
+    base_offset_size = data[pos + 1] >> 4
+    index_size = data[pos + 1] & 0x0F if version in (1, 2) else 0
+    pos += 2
+
+    id_size = 2 if version < 2 else 4
+    item_count = read_uint(data, pos, id_size)
+    pos += id_size
+
+    items = {}
+    for _ in range(item_count):
+        item_id = read_uint(data, pos, id_size)
+        pos += id_size
+        construction_method = 0
+        if version in (1, 2):
+            construction_method = read_uint(data, pos, 2) & 0x0F
+            pos += 2
+        pos += 2  # data_reference_index
+        base_offset = read_uint(data, pos, base_offset_size)
+        pos += base_offset_size
+        extent_count = read_uint(data, pos, 2)
+        pos += 2
+
+        if construction_method == 0:
+            origin, limit = 0, len(data)
+        elif construction_method == 1 and idat:
+            origin, limit = idat
+        else:
+            raise UnsupportedFormat("Unsupported iloc construction method")
+
+        ranges = []
+        for _ in range(extent_count):
+            pos += index_size
+            extent_offset = read_uint(data, pos, offset_size)
+            pos += offset_size
+            extent_length = read_uint(data, pos, length_size)
+            pos += length_size
+
+            extent_start = origin + base_offset + extent_offset
+            extent_end = extent_start + extent_length if extent_length else limit
+            if extent_end > limit:
+                raise UnsupportedFormat(f"Item {item_id} extends beyond its data")
+            ranges.append((extent_start, extent_end))
+        items[item_id] = ranges
+    return items
+
 
+# HEIF items that only carry metadata
+HEIF_METADATA_ITEM_TYPES = (b"Exif", b"mime", b"uri ")
 
-def find_videos(path):
+
+def isobmff_payload_ranges(data):
     """
-    Recursively find jpg and jpeg images on the specified path
+    Returns the byte ranges of the media payload of an ISOBMFF file
+
+    For HEIF/HEIC images these are the extents of every item listed in the
+    iloc box, in item id order, except for metadata (Exif and XMP) items.
+    For MP4/MOV videos these are the payloads of the mdat boxes. Metadata
+    lives in the moov/udta and meta boxes, so editing it leaves the ranges
+    (though not necessarily their offsets) unchanged.
     """
-    # the question mark matches a single chacter, the p is not optional
-    mp4s = list(Path(abspath(path)).rglob("**/*.mp4"))
-    MP4s = list(Path(abspath(path)).rglob("**/*.MP4"))
-    return sorted(mp4s + MP4s)
+    size = len(data)
+    if size < 8 or bytes(data[4:8]) != b"ftyp":
+        raise UnsupportedFormat("Missing ISOBMFF ftyp box")
 
+    boxes = list(iter_boxes(data, 0, size))
 
-def index_videos(db, path):
-    pass
+    for box_type, start, end in boxes:
+        if box_type != b"meta":
+            continue
+        children = start + 4  # meta is a full box
+        iloc = find_box(data, children, end, b"iloc")
+        iinf = find_box(data, children, end, b"iinf")
+        if not iloc:
+            break
 
+        idat = find_box(data, children, end, b"idat")
+        item_types = heif_item_types(data, *iinf) if iinf else {}
+        items = heif_item_ranges(data, *iloc, idat)
 
-def index(db, args):
-    index_media(db, args.path, args.force_reindex)
+        ranges = []
+        for item_id in sorted(items):
+            if item_types.get(item_id) not in HEIF_METADATA_ITEM_TYPES:
+                ranges.extend(items[item_id])
+        return ranges
 
+    ranges = [(start, end) for box_type, start, end in boxes if box_type == b"mdat"]
+    if not ranges:
+        raise UnsupportedFormat("No media data found")
+    return ranges
 
-def dump(db, args):
-    print(json_dump(db.dump()))
 
+ISOBMFF_EXTENSIONS = (".mp4", ".mov", ".heic")
 
-def get_duplicate(db, args):
-    duplicates, images = get_image_sets(db)
-    print(json_dump(duplicates[list(duplicates.keys())[0]]))
 
+def new_digest(algorithm):
+    """Returns a new hash object for one of DIGEST_ALGORITHMS"""
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise ValueError(f"Unsupported digest algorithm {algorithm}")
+    return new_hash(algorithm)
 
-def images_by_tag(db, args):
-    """Return list of image paths that have a matchin exiftag value"""
-    matches = []
 
-    _, images = get_image_sets(db)
-    for _, v in images.items():
-        for i in v:
-            exifdata = decode_exifdata(i.get("exifdata_encoded", ""))
-            if exifdata.get(args.tag, "") == args.value:
-                matches.append(i["path"])
+@contextmanager
+def mapped_payload(path):
+    """
+    Maps path into memory and yields (data, ranges) where ranges are the
+    byte ranges of the media payload. Only the file structure is parsed.
 
-    print(json_dump(matches))
+    Raises UnsupportedFormat when the file can not be parsed natively
+    """
+    lower_path = path.lower()
+    if lower_path.endswith(JPEG_EXTENSIONS):
+        payload_ranges = jpeg_payload_ranges
+    elif lower_path.endswith(ISOBMFF_EXTENSIONS):
+        payload_ranges = isobmff_payload_ranges
+    else:
+        raise UnsupportedFormat(f"No native parser for {basename(path)}")
+
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise UnsupportedFormat("Empty file")
 
+    with data:
+        yield data, payload_ranges(data)
 
-def unique_tag_values(db, args):
-    """Returns a list of unique values for a tag"""
-    _, images = get_image_sets(db)
-    unique_values = set()
-    for _, v in images.items():
-        for i in v:
-            try:
-                exifdata = decode_exifdata(i.get("exifdata_encoded", ""))
-                unique_values.add(exifdata.get(args.tag, ""))
-            except BaseException as e:
-                print(i["path"], e)
 
-    print(json_dump(list(unique_values)))
+def sample_ranges(ranges, sample_size):
+    """
+    Returns the ranges covering the first and last sample_size bytes of
+    the data described by ranges, or all ranges if it is not larger
+    """
+    if sum(end - start for start, end in ranges) <= 2 * sample_size:
+        return ranges
 
+    def head(ranges):
+        remaining = sample_size
+        for start, end in ranges:
+            if remaining <= 0:
+                break
+            yield start, min(end, start + remaining)
+            remaining -= end - start
 
-def fix(db, args):
-    dupes, images = get_image_sets(db)
-    for _, duplicate_set in dupes.items():
-        if duplicate_set[0]["path"].lower().endswith("mp4"):
-            fix_videos(duplicate_set)
-        if duplicate_set[0]["path"].lower().endswith("avi"):
-            fix_videos(duplicate_set)
-        if duplicate_set[0]["path"].lower().endswith("mov"):
-            fix_videos(duplicate_set)
-        else:
-            fix_images(duplicate_set)
+    tail = [
+        (-end, -start) for start, end in head((-e, -s) for s, e in reversed(ranges))
+    ]
+    return list(head(ranges)) + tail[::-1]
 
 
-def fix_videos(duplicate_set):
-    EncodingTime = None
-    MediaClassPrimaryID = None
-    MediaClassSecondaryID = None
+def native_imagedata_checksum(path, algorithm=DEFAULT_DIGEST):
+    """
+    Calculates the imagedata checksum in-process by walking the file structure
+    For JPEG images the same bytes are hashed that "exiftool -all= -o - -b"
+    writes, tests/test_jpeg_payload.py checks this against reference files
+    where exiftool is installed. For HEIC images and MP4/MOV videos only the
+    media payload is hashed, in fixed-size chunks, so memory use does not
+    depend on the file size.
+
+    Raises UnsupportedFormat when the file can not be parsed natively
+    """
+    with mapped_payload(path) as (data, ranges):
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        return hash_ranges(data, ranges, new_digest(algorithm)).hexdigest()
 
-    for image in duplicate_set:
-        exifdata = decode_exifdata(image.get("exifdata_encoded", ""))
 
-        _EncodingTime = exifdata.get("Encoding Time", None)
-        if _EncodingTime:
-            EncodingTime = _EncodingTime
+def native_payload_size(path):
+    """Returns the size of the media payload that is hashed for path"""
+    with mapped_payload(path) as (_, ranges):
+        return sum(end - start for start, end in ranges)
 
-        _MediaClassPrimaryID = exifdata.get("Media Class Primary ID", None)
-        if _MediaClassPrimaryID:
-            MediaClassPrimaryID = _MediaClassPrimaryID
 
-        _MediaClassSecondaryID = exifdata.get("Media Class Secondary ID", None)
-        if _MediaClassSecondaryID:
-            MediaClassSecondaryID = _MediaClassSecondaryID
+def native_partial_checksum(path, algorithm=DEFAULT_DIGEST):
+    """Hashes only the start and the end of the media payload of path"""
+    with mapped_payload(path) as (data, ranges):
+        ranges = sample_ranges(ranges, PARTIAL_SAMPLE_SIZE)
+        return hash_ranges(data, ranges, new_digest(algorithm)).hexdigest()
 
-        # We temporaryily write to Image Description before removing it
-        # To force update the Media Data Offset field
-        _cmd = [
-            EXIFTOOL_CMD,
-            image["path"],
-            "-ImageDescription=temp",
-            "-overwrite_original",
-        ]
-        print("cmd:", " ".join(_cmd))
-        run(_cmd, capture_output=True)
 
-        _cmd = [
-            EXIFTOOL_CMD,
-            image["path"],
-            "-XMP:All=",  # remove all XMP data
-            "-ImageDescription=",
-            "-overwrite_original",
-        ]
-        print("cmd:", " ".join(_cmd))
-        run(_cmd, capture_output=True)
+def native_payload_checksums(path, algorithm=DEFAULT_DIGEST):
+    """
+    Returns (payload_size, partial_checksum, imagedata_checksum) of path
+    The file structure is parsed once. A payload that the partial sample
+    covers completely is hashed once, both checksums are the same then.
+    """
+    with mapped_payload(path) as (data, ranges):
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        size = sum(end - start for start, end in ranges)
+        checksum = hash_ranges(data, ranges, new_digest(algorithm)).hexdigest()
+        if size <= 2 * PARTIAL_SAMPLE_SIZE:
+            return size, checksum, checksum
+        samples = sample_ranges(ranges, PARTIAL_SAMPLE_SIZE)
+        partial = hash_ranges(data, samples, new_digest(algorithm)).hexdigest()
+        return size, partial, checksum
+
+
+def stat_fingerprint(path):
+    """
+    Returns a (size, mtime_ns, inode, dev) tuple for path
+    When it changes, the file has to be indexed again
+    """
+    st = stat(path)
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
 
-    for image in duplicate_set:
-        _cmd = [
-            EXIFTOOL_CMD,
-            image["path"],
-            f"-EncodingTime={EncodingTime}",
-            f"-MediaClassPrimaryID={MediaClassPrimaryID}",
-            f"-MediaClassSecondaryID={MediaClassSecondaryID}",
-            "-overwrite_original",
-        ]
-        print("cmd:", " ".join(_cmd))
-        run(_cmd, capture_output=True)
 
+def to_signed64(value):
+    """Converts an unsigned 64-bit integer to the signed range SQLite stores"""
+    return value - (1 << 64) if value >= (1 << 63) else value
 
-def fix_images(duplicate_set):
-    """Fix exif data in duplicate sets"""
-    tags = {
-        "Software": [],
-    }
 
-    for image in duplicate_set:
-        exifdata = decode_exifdata(i.get("exifdata_encoded", ""))
-        tags["Software"].append(exifdata.get("Software", ""))
-        _cmd = [
-            EXIFTOOL_CMD,
-            image["path"],
-            "-XMP:All=",  # remove all XMP data
-            "-ThumbnailImage=",  # remove thumbnails to fix incorrect thumbnail offset (can be regenerated)
-            "-OriginatingProgram=",  # remove (created by Shotwell in my specific case)
-            "-ProgramVersion=",  # remove (created by Shotwell in my specific case)
-            "-ApplicationRecordVersion=",  # don't need it
-            "-CurrentIPTCDigest=",  # don't need it
-            "-overwrite_original",
-        ]
+def to_unsigned64(value):
+    return value + (1 << 64) if value < 0 else value
 
-        print("cmd:", " ".join(_cmd))
-        run(_cmd, capture_output=True)
 
-    if len(tags["Software"]) > 1:
-        _unique = list(set(tags["Software"]))
-        if len(_unique) > 1:
-            _unique_valid = [i for i in _unique if i not in INVALID_SOFTWARE_TAG_VALUES]
-            if len(_unique_valid) == 1:
-                if _unique_valid[0] == "":
-                    for i in duplicate_set:
-                        _cmd = [
-                            EXIFTOOL_CMD,
-                            i["path"],
-                            f"-Software={_unique_valid[0]}",
-                            "-overwrite_original",
-                        ]
+# Set once a missing Pillow was reported, so it is only reported once
+PILLOW_MISSING_REPORTED = False
 
-                        print("unique_values:", _unique, "cmd:", " ".join(_cmd))
-                        run(_cmd, capture_output=True)
 
+def pillow_available():
+    """
+    Returns whether Pillow can be imported, logs a warning the first time
+    it can not. Call it before worker processes are forked, so they inherit
+    that it was reported.
+    """
+    global PILLOW_MISSING_REPORTED
+    if PILLOW_MISSING_REPORTED:
+        return False
+    try:
+        import PIL
+    except ImportError:
+        PILLOW_MISSING_REPORTED = True
+        logger.warning("Pillow is not installed, perceptual hashes are not calculated")
+    return not PILLOW_MISSING_REPORTED
+
+
+def perceptual_hash(path):
+    """
+    Calculates a 64-bit difference hash (dHash) of an image
+    The image is reduced to a 9x8 grayscale thumbnail and every bit records
+    whether a pixel is brighter than its right neighbour. Re-encoded, resized
+    and lightly edited copies of an image end up with a small Hamming
+    distance between their hashes.
 
-def stats(db, args):
-    """Print statistics on duplicates"""
-    dupes, images = get_image_sets(db)
-    print(
-        f"Found {len(images.items())} sets of images of which {len(dupes.items())} have duplicates"
-    )
+    Returns None when Pillow is not installed or the image can not be decoded
+    """
+    if not pillow_available():
+        return None
+    from PIL import Image, ImageOps
 
+    try:
+        from pillow_heif import register_heif_opener
 
-def clean(db, args):
-    """Print statistics on duplicates"""
-    for i in db.dump():
-        if not isfile(i["path"]):
-            logger.info(f"Removing missing file at {i['path']}")
-            db.remove_by_path(i["path"])
+        register_heif_opener()
+    except ImportError:
+        pass
 
+    try:
+        with profile_stage("phash"), Image.open(path) as image:
+            # let the JPEG decoder scale down while decoding
+            image.draft("L", (64, 64))
+            image = ImageOps.exif_transpose(image).convert("L")
+            pixels = image.resize((9, 8), Image.LANCZOS).tobytes()
+    except Exception as e:
+        logger.debug(f'Could not calculate perceptual hash of "{path}": {e}')
+        return None
 
-def parse_args():
-    parser = ArgumentParser(
-        prog="imgtool",
-        description="Tool to compare images in a directory and find duplicates while ignoring exif data",
-    )
-    parser.add_argument(
-        "-D", "--dbpath", type=str, default=f"{env['HOME']}/imgtool.sqlite"
-    )
-    parser.set_defaults(func=parser.print_usage)
-    subparsers = parser.add_subparsers()
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            value = (value << 1) | (left > pixels[row * 9 + column + 1])
+    return value
 
-    parser_index = subparsers.add_parser("index", help="Index image files")
-    parser_index.set_defaults(func=index)
-    parser_index.add_argument("path", help="Path to search for images (recursively)")
-    parser_index.add_argument(
-        "-f",
-        "--force-reindex",
-        action="store_true",
-        help="Force re-indexation of existing files",
-    )
 
-    parser_dump = subparsers.add_parser("dump", help="Dump all rows in the database")
-    parser_dump.set_defaults(func=dump)
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree over 64-bit hashes using the Hamming distance
+
+    Every child of a node is stored under its distance to that node, the
+    triangle inequality then limits a search to the children whose distance
+    is within max_distance of the distance between the query and the node.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Returns (distance, item) for all items within max_distance of value"""
+        matches = []
+        if self.root is None:
+            return matches
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return matches
+
+
+def similar_pairs(hashes, max_distance):
+    """
+    Returns (item_a, item_b, distance) for every pair of (item, hash) in
+    hashes whose hashes are within max_distance of each other
+    """
+    tree = BKTree()
+    pairs = []
+    for item, value in hashes:
+        for distance, match in tree.search(value, max_distance):
+            pairs.append((match, item, distance))
+        tree.add(value, item)
+    return pairs
+
+
+def popcount64(array):
+    """Returns the number of set bits of every element of a uint64 array"""
+    import numpy as np
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(array)
+
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    counts = table[array.view(np.uint8)]
+    return counts.reshape(array.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def similar_pairs_numpy(hashes, max_distance, block_size=SIMILAR_BLOCK_SIZE, jobs=1):
+    """
+    Same as similar_pairs, but compares all hashes with NumPy
+
+    The hashes are loaded into a contiguous uint64 array which is compared
+    in tiles of block_size x block_size, so memory use is bounded by the
+    block size instead of the number of hashes. NumPy releases the GIL,
+    every thread of jobs compares a stripe of block_size rows at a time
+    against the columns of the upper triangle, tile by tile.
+    """
+    import numpy as np
+
+    items = []
+    values = []
+    for item, value in hashes:
+        items.append(item)
+        values.append(value)
+    array = np.array(values, dtype=np.uint64)
+    total = len(array)
+
+    def compare(i):
+        stripe = array[i : i + block_size, None]
+        found = []
+        for j in range(i, total, block_size):
+            distances = popcount64(stripe ^ array[None, j : j + block_size])
+            matches = distances <= max_distance
+            if i == j:
+                # only compare every pair within a diagonal tile once
+                matches = np.triu(matches, k=1)
+            rows, columns = np.nonzero(matches)
+            found.append((i + rows, j + columns, distances[rows, columns]))
+        return found
+
+    pairs = []
+    with ThreadPoolExecutor(jobs) as executor:
+        stripes = range(0, total, block_size)
+        for found in imap_ordered(executor, compare, stripes, jobs * 2):
+            for rows, columns, distances in found:
+                pairs.extend(
+                    (items[a], items[b], int(d))
+                    for a, b, d in zip(rows.tolist(), columns.tolist(), distances)
+                )
+    return pairs
+
+
+class ImageData(object):
+    """
+    Defines an image object. It contains all the attributes we want to query for deduplication
+    """
+
+    def __init__(self, path, digest=DEFAULT_DIGEST, tiered=False):
+        self.name = basename(path)
+        self.path = abspath(path)
+        self.digest = digest
+        self.fingerprint = stat_fingerprint(self.path)
+        self.imagedata_checksum = None
+        self.exifdata_checksum = None
+        self.exifdata = {}
+        self.phash = None
+        self.payload_size = None
+        self.partial_checksum = None
+        self.calculate_payload_checksums(tiered)
+        self.parse_exifdata()
+        if self.path.lower().endswith(IMAGE_EXTENSIONS):
+            self.phash = perceptual_hash(self.path)
+
+    def parse_exifdata(self):
+        """
+        Creates a checksum of only the image exif data
+        It excludes a bunch of field that are always different
+        Such as creation, modification or access times
+        """
+        _cmd = [
+            self.path,
+            "-x",
+            "Directory",
+            "-x",
+            "FileName",
+            "-x",
+            "FilePermissions",
+            "-x",
+            "FileAccessDate",
+            "-x",
+            "FileModifyDate",
+            "-x",
+            "FileInodeChangeDate",
+            "-x",
+            "ExifToolVersion",
+        ]
+
+        stdout = exiftool(_cmd)
+
+        # parse stdout to mapping
+        with profile_stage("exif_parse"):
+            _exifdata = {}
+            for line in stdout.decode("cp850").split("\n"):
+                if not line:
+                    continue
+                separator_index = line.index(":")
+                k = line[:separator_index].rstrip(" ")
+                v = line[separator_index + 2 :].lstrip(" ")
+                _exifdata.update({k: v})
+
+            self.exifdata = dict(sorted(_exifdata.items()))
+            self.exifdata_checksum = md5(str(self.exifdata).encode()).hexdigest()
+
+    def calculate_payload_checksums(self, tiered=False):
+        """
+        Records the payload size and calculates the partial and full checksum
+        When tiered, only the payload size is recorded for files that can be
+        parsed natively, their checksums are calculated later and only when
+        another file has a payload of the same size
+        """
+        try:
+            if tiered:
+                self.payload_size = native_payload_size(self.path)
+                return
+            (
+                self.payload_size,
+                self.partial_checksum,
+                self.imagedata_checksum,
+            ) = native_payload_checksums(self.path, self.digest)
+        except UnsupportedFormat:
+            self.calculate_imagedata_checksum()
+
+    def calculate_imagedata_checksum(self):
+        """
+        Creates a checksum of the image data without including exif data
+        Files that can not be parsed natively are stripped by exiftool, its
+        output is hashed in chunks while it is being read
+        """
+        try:
+            self.imagedata_checksum = native_imagedata_checksum(self.path, self.digest)
+            return
+        except UnsupportedFormat as e:
+            logger.debug(f'Falling back to exiftool for "{self.path}": {e.message}')
+
+        _cmd = [
+            self.path,
+            "-all=",
+            "-o",
+            "-",
+            "-b",
+        ]
+
+        digest = new_digest(self.digest)
+        exiftool(_cmd, sink=digest.update)
+
+        self.imagedata_checksum = digest.hexdigest()
+
+
+def create_image_data_indexes(cursor):
+    """Create the indexes on the checksum columns of the image_data table"""
+    logger.debug('Create index for "imagedata_checksum" column on the image_data table')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS imagedata_checksum ON image_data(imagedata_checksum)"
+    )
+
+    logger.debug('Create index for "exifdata_checksum" column on the image_data table')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS exifdata_checksum ON image_data(exifdata_checksum)"
+    )
+
+    logger.debug(
+        'Create compound index for the "imagedata_checksum" and "exifdata_checksum" columns on the image_data table'
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS checksums ON image_data(imagedata_checksum, exifdata_checksum)"
+    )
+
+
+def migrate_unique_paths(cursor):
+    """Drop all but the most recent row for a path and make paths unique"""
+    cursor.execute(
+        "DELETE FROM image_data WHERE rowid NOT IN "
+        "(SELECT MAX(rowid) FROM image_data GROUP BY path)"
+    )
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS path ON image_data(path)")
+
+
+def table_columns(cursor, table):
+    """Returns the column names of table"""
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+
+def add_missing_columns(cursor, table, columns):
+    """Add the columns that do not exist yet to table"""
+    existing = table_columns(cursor, table)
+    for column in columns:
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+
+def migrate_fingerprints(cursor):
+    """Add the stat fingerprint columns"""
+    add_missing_columns(cursor, "image_data", FINGERPRINT_ROWS)
+
+
+def migrate_exif_tags(cursor):
+    """
+    Give image_data an INTEGER PRIMARY KEY, so row ids stay stable when the
+    database is vacuumed, and add the exif_tags table which stores every
+    exif tag of an image as a separate, indexed row
+    """
+    columns = ",".join(table_columns(cursor, "image_data"))
+    cursor.execute(f"CREATE TABLE image_data_new(id INTEGER PRIMARY KEY,{columns})")
+    cursor.execute(
+        f"INSERT INTO image_data_new (id,{columns}) SELECT rowid,{columns} FROM image_data"
+    )
+    cursor.execute("DROP TABLE image_data")
+    cursor.execute("ALTER TABLE image_data_new RENAME TO image_data")
+    create_image_data_indexes(cursor)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS path ON image_data(path)")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS exif_tags(image_rowid, tag, value)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS tag_value ON exif_tags(tag, value)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS image_rowid ON exif_tags(image_rowid)")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS image_data_delete AFTER DELETE ON image_data
+        BEGIN
+            DELETE FROM exif_tags WHERE image_rowid = old.id;
+        END
+    """)
+
+    logger.info("Populating the exif_tags table")
+    rows = cursor.connection.execute(
+        "SELECT id, exifdata_encoded, path FROM image_data"
+    )
+    while batch := rows.fetchmany(DB_BATCH_SIZE):
+        tags = []
+        for rowid, exifdata_encoded, path in batch:
+            try:
+                exifdata = decode_exifdata(exifdata_encoded)
+            except Exception as e:
+                logger.warning(f'Could not decode exif data of "{path}": {e}')
+                continue
+            tags.extend((rowid, tag, value) for tag, value in exifdata.items())
+        cursor.executemany(
+            "INSERT INTO exif_tags (image_rowid, tag, value) VALUES (?, ?, ?)", tags
+        )
+
+
+def migrate_phash(cursor):
+    """Add the perceptual hash column"""
+    add_missing_columns(cursor, "image_data", ["phash"])
+
+
+def migrate_isobmff_checksums(cursor):
+    """
+    HEIC and video checksums are now calculated from the media payload
+    Invalidate the stat fingerprints of these files so the next index run
+    calculates their checksums again
+    """
+    cursor.execute(
+        f"""
+        UPDATE image_data SET size = -1, mtime_ns = -1, inode = -1, dev = -1 WHERE (
+            {" OR ".join("lower(path) LIKE ?" for _ in ISOBMFF_EXTENSIONS)}
+        )
+        """,
+        [f"%{extension}" for extension in ISOBMFF_EXTENSIONS],
+    )
+
+
+def migrate_metadata(cursor):
+    """
+    Add the metadata table, databases that already contain rows have
+    md5 imagedata checksums
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS metadata(key PRIMARY KEY, value)")
+    if cursor.execute("SELECT 1 FROM image_data LIMIT 1").fetchone():
+        cursor.execute(
+            "INSERT OR IGNORE INTO metadata VALUES ('digest', ?)", (DEFAULT_DIGEST,)
+        )
+
+
+def migrate_payload_checksums(cursor):
+    """Add the payload size and partial checksum columns for tiered indexing"""
+    add_missing_columns(cursor, "image_data", ["payload_size", "partial_checksum"])
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS payload ON image_data(payload_size, partial_checksum)"
+    )
+
+
+# Schema migrations in order, the index + 1 is the resulting schema version
+MIGRATIONS = [
+    migrate_unique_paths,
+    migrate_fingerprints,
+    migrate_exif_tags,
+    migrate_phash,
+    migrate_isobmff_checksums,
+    migrate_metadata,
+    migrate_payload_checksums,
+]
+
+
+class JournalMismatch(Exception):
+    def __init__(self, message="Journal belongs to another fix plan"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class DigestMismatch(Exception):
+    def __init__(self, message="Database uses a different digest algorithm"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ImageDataDB(object):
+    """
+    Implements database operations for image data
+    """
+
+    def __init__(
+        self,
+        sqlite_db_path,
+        batch_size=DB_BATCH_SIZE,
+        batch_interval=DB_BATCH_INTERVAL,
+        digest=None,
+        readonly=False,
+    ):
+        self.db = abspath(sqlite_db_path)
+        # a database that is missing or needs migrations is opened for writing
+        self.readonly = readonly and self.schema_version() == len(MIGRATIONS)
+        self.connection = self.connect()
+        self.cursor = self.connection.cursor()
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.pending = []
+        self.pending_upserts = []
+        self.pending_updates = {}
+        self.pending_tags = []
+        self.last_flush = monotonic()
+        if not self.readonly:
+            self.initialize_database()
+        self.digest = self.initialize_digest(digest)
+
+    def connect(self, readonly=None):
+        """
+        Opens a tuned connection to the database. Writers switch the database
+        to WAL mode, so read-only connections never block them and are never
+        blocked by them.
+        """
+        if readonly is None:
+            readonly = self.readonly
+        if readonly:
+            # only these characters have a meaning in an SQLite URI path
+            path = self.db.replace("%", "%25").replace("?", "%3f").replace("#", "%23")
+            connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            connection = sqlite3.connect(self.db)
+            connection.execute("PRAGMA journal_mode = WAL")
+            # with WAL a crash can only lose the last commits, never corrupt
+            connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute(f"PRAGMA cache_size = {-DB_CACHE_SIZE // 1024}")
+        connection.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        return connection
+
+    def schema_version(self):
+        """Returns the schema version of the database, None if it does not exist"""
+        if not isfile(self.db):
+            return None
+        connection = self.connect(readonly=True)
+        try:
+            return connection.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            connection.close()
+
+    def initialize_database(self):
+        logger.debug("Create image_table data if it does not exist")
+        self.cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS image_data({','.join(IMAGE_DATA_ROWS)})"
+        )
+
+        create_image_data_indexes(self.cursor)
+
+        self.migrate()
+
+    def initialize_digest(self, digest):
+        """
+        Returns the digest algorithm of the database. A database without rows
+        uses digest, it is recorded when the first rows are written. Using a
+        different algorithm than the one the database was created with would
+        mix checksums that can never match.
+        """
+        stored = self.get_metadata("digest")
+        if stored is None:
+            stored = digest or DEFAULT_DIGEST
+            new_digest(stored)
+        elif digest and digest != stored:
+            raise DigestMismatch(
+                f'Database "{self.db}" uses {stored} checksums, not {digest}'
+            )
+        return stored
+
+    def get_metadata(self, key):
+        res = self.cursor.execute("SELECT value FROM metadata WHERE key = ?", (key,))
+        row = res.fetchone()
+        return row[0] if row else None
+
+    def set_metadata(self, key, value):
+        self.cursor.execute(
+            "INSERT INTO metadata VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+        self.connection.commit()
+
+    def migrate(self):
+        """
+        Applies the schema migrations the database has not seen yet
+        The schema version is tracked with the user_version pragma
+        """
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        for version, migration in enumerate(MIGRATIONS[version:], start=version):
+            logger.info(f"Migrating database to schema version {version + 1}")
+            migration(self.cursor)
+            self.cursor.execute(f"PRAGMA user_version = {version + 1}")
+            self.connection.commit()
+
+    @staticmethod
+    def image_data_row(image_data):
+        """Returns the column values for an image_data object"""
+        return (
+            image_data.name,
+            image_data.exifdata_checksum,
+            image_data.imagedata_checksum,
+            encode_exifdata(image_data.exifdata),
+            image_data.path,
+            *image_data.fingerprint,
+            None if image_data.phash is None else to_signed64(image_data.phash),
+            image_data.payload_size,
+            image_data.partial_checksum,
+        )
+
+    def insert(self, image_data, upsert=False):
+        """
+        insert a single image_data object as one row
+        """
+        self.insert_many([image_data], upsert)
+
+    def insert_many(self, image_datas, upsert=False):
+        """
+        Queues image_data objects for insertion, they are written in batches
+        When upsert is set, an existing row with the same path is replaced
+        """
+        for image_data in image_datas:
+            row = self.image_data_row(image_data)
+            (self.pending_upserts if upsert else self.pending).append(row)
+            self.pending_tags.extend(
+                (tag, value, image_data.path)
+                for tag, value in image_data.exifdata.items()
+            )
+
+        pending = len(self.pending) + len(self.pending_upserts)
+        if (
+            pending >= self.batch_size
+            or monotonic() - self.last_flush >= self.batch_interval
+        ):
+            self.flush()
+
+    def update(self, path, **values):
+        """Queues an update of columns of the row for path"""
+        columns = tuple(values)
+        updates = self.pending_updates.setdefault(columns, [])
+        updates.append((*values.values(), path))
+        if len(updates) >= self.batch_size:
+            self.flush()
+
+    def update_fingerprint(self, path, fingerprint):
+        """Queues an update of the stat fingerprint of the row for path"""
+        self.update(path, **dict(zip(FINGERPRINT_ROWS, fingerprint)))
+
+    def update_phash(self, path, phash):
+        """Queues an update of the perceptual hash of the row for path"""
+        self.update(path, phash=to_signed64(phash))
+
+    def paths_needing_partial_checksum(self):
+        """
+        Returns the paths of rows without a partial checksum whose payload
+        size is the same as that of another row
+        """
+        res = self.cursor.execute("""
+            SELECT path FROM image_data WHERE partial_checksum IS NULL
+            AND payload_size IN (
+                SELECT payload_size FROM image_data WHERE payload_size IS NOT NULL
+                GROUP BY payload_size HAVING COUNT(*) > 1
+            )
+            """)
+        return [path for path, in res.fetchall()]
+
+    def paths_needing_checksum(self, all_pending=False):
+        """
+        Returns the paths of rows without an imagedata checksum whose payload
+        size and partial checksum are the same as that of another row, or of
+        all rows without one when all_pending is set
+        """
+        if all_pending:
+            res = self.cursor.execute(
+                "SELECT path FROM image_data WHERE imagedata_checksum IS NULL"
+            )
+            return [path for path, in res.fetchall()]
+
+        res = self.cursor.execute("""
+            SELECT path FROM image_data WHERE imagedata_checksum IS NULL
+            AND (payload_size, partial_checksum) IN (
+                SELECT payload_size, partial_checksum FROM image_data
+                WHERE partial_checksum IS NOT NULL
+                GROUP BY payload_size, partial_checksum HAVING COUNT(*) > 1
+            )
+            """)
+        return [path for path, in res.fetchall()]
+
+    def paths_without_payload_size(self):
+        """Returns the paths of natively parsable rows without a payload size"""
+        res = self.cursor.execute(
+            "SELECT path FROM image_data WHERE payload_size IS NULL"
+        )
+        extensions = JPEG_EXTENSIONS + ISOBMFF_EXTENSIONS
+        return [path for path, in res.fetchall() if path.lower().endswith(extensions)]
+
+    def phashes(self):
+        """Yields (path, phash) for all rows with a perceptual hash"""
+        res = self.connection.execute(
+            "SELECT path, phash FROM image_data WHERE phash IS NOT NULL ORDER BY id"
+        )
+        for path, phash in res:
+            yield path, to_unsigned64(phash)
+
+    def paths_without_phash(self):
+        """Returns the paths of all images that have no perceptual hash yet"""
+        res = self.cursor.execute("SELECT path FROM image_data WHERE phash IS NULL")
+        return [
+            path for path, in res.fetchall() if path.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+
+    def stale_paths(self, paths):
+        """Returns the paths whose stat fingerprint differs from their row"""
+        stale = []
+        for path in paths:
+            res = self.cursor.execute(
+                f"SELECT {','.join(FINGERPRINT_ROWS)} FROM image_data WHERE path = ?",
+                (path,),
+            )
+            row = res.fetchone()
+            try:
+                if row is None or tuple(row) != stat_fingerprint(path):
+                    stale.append(path)
+            except OSError:
+                continue
+        return stale
+
+    def fingerprints(self):
+        """
+        Returns a mapping of path to stat fingerprint for all rows
+        Rows indexed before fingerprints were stored map to None
+        """
+        res = self.cursor.execute(
+            f"SELECT path, {','.join(FINGERPRINT_ROWS)} FROM image_data"
+        )
+        return {
+            path: None if None in fingerprint else tuple(fingerprint)
+            for path, *fingerprint in res
+        }
+
+    def flush(self):
+        """Writes all pending rows in a single transaction"""
+        rows = len(self.pending) + len(self.pending_upserts)
+        rows += sum(map(len, self.pending_updates.values()))
+        profile_count("rows_written", rows)
+        with profile_stage("db_write"):
+            columns = ",".join(IMAGE_DATA_ROWS)
+            placeholders = ",".join("?" * len(IMAGE_DATA_ROWS))
+
+            if self.pending or self.pending_upserts:
+                self.cursor.execute(
+                    "INSERT OR IGNORE INTO metadata VALUES ('digest', ?)",
+                    (self.digest,),
+                )
+            if self.pending:
+                self.cursor.executemany(
+                    f"INSERT INTO image_data ({columns}) VALUES ({placeholders})",
+                    self.pending,
+                )
+            if self.pending_upserts:
+                updates = ",".join(f"{c} = excluded.{c}" for c in IMAGE_DATA_ROWS)
+                self.cursor.executemany(
+                    f"""
+                    INSERT INTO image_data ({columns}) VALUES ({placeholders})
+                    ON CONFLICT(path) DO UPDATE SET {updates}
+                    """,
+                    self.pending_upserts,
+                )
+                # the row id is kept on conflict, replace the tags of the old row
+                self.cursor.executemany(
+                    """
+                    DELETE FROM exif_tags WHERE image_rowid =
+                    (SELECT id FROM image_data WHERE path = ?)
+                    """,
+                    [
+                        (row[IMAGE_DATA_ROWS.index("path")],)
+                        for row in self.pending_upserts
+                    ],
+                )
+            if self.pending_tags:
+                self.cursor.executemany(
+                    """
+                    INSERT INTO exif_tags (image_rowid, tag, value)
+                    SELECT id, ?, ? FROM image_data WHERE path = ?
+                    """,
+                    self.pending_tags,
+                )
+            for columns, updates in self.pending_updates.items():
+                assignments = ",".join(f"{c} = ?" for c in columns)
+                self.cursor.executemany(
+                    f"UPDATE image_data SET {assignments} WHERE path = ?", updates
+                )
+
+            self.connection.commit()
+            self.pending = []
+            self.pending_upserts = []
+            self.pending_updates = {}
+            self.pending_tags = []
+            self.last_flush = monotonic()
+
+    def close(self):
+        if not self.readonly:
+            self.flush()
+        self.connection.close()
+
+    def maintenance(self, vacuum=True):
+        """
+        Updates the query planner statistics, moves the WAL into the database
+        and, with vacuum, rebuilds the database file to reclaim free pages
+        """
+        self.flush()
+        logger.info("Analyzing tables and indexes")
+        self.cursor.execute("ANALYZE")
+        self.connection.commit()
+        logger.info("Checkpointing the write-ahead log")
+        self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if vacuum:
+            logger.info("Vacuuming the database")
+            self.cursor.execute("VACUUM")
+
+    def remove_by_path(self, path):
+        self.cursor.execute("DELETE FROM image_data WHERE path = ?", (path,))
+        self.connection.commit()
+
+    def remove_many(self, paths):
+        """Removes the rows of all paths in a single transaction"""
+        profile_count("rows_deleted", len(paths))
+        with profile_stage("db_write"), self.connection:
+            self.connection.executemany(
+                "DELETE FROM image_data WHERE path = ?", ((path,) for path in paths)
+            )
+
+    def merge(self, source_path):
+        """
+        Combines the rows of another database into this one, set-based in a
+        single transaction. When both have a row for a path, the row of the
+        more recently modified file wins. The exif_tags of every row taken
+        from the source are re-mapped to the row ids of this database.
+        Returns the number of rows taken from the source.
+        """
+        self.flush()
+        columns = ",".join(IMAGE_DATA_ROWS)
+        updates = ",".join(f"{c} = excluded.{c}" for c in IMAGE_DATA_ROWS)
+        # rows that are identical to their source row after the upsert
+        taken = " AND ".join(
+            f"t.{c} IS s.{c}" for c in ("path", "mtime_ns", "exifdata_checksum")
+        )
+
+        self.cursor.execute("ATTACH DATABASE ? AS source", (source_path,))
+        try:
+            with self.connection:
+                self.cursor.execute(f"""
+                    INSERT INTO image_data ({columns})
+                    SELECT {columns} FROM source.image_data WHERE true
+                    ON CONFLICT(path) DO UPDATE SET {updates}
+                    WHERE image_data.mtime_ns IS NULL
+                    OR excluded.mtime_ns > image_data.mtime_ns
+                    """)
+                self.cursor.execute(f"""
+                    DELETE FROM exif_tags WHERE image_rowid IN (
+                        SELECT t.id FROM main.image_data t
+                        JOIN source.image_data s ON s.path = t.path WHERE {taken}
+                    )
+                    """)
+                self.cursor.execute(f"""
+                    INSERT INTO exif_tags (image_rowid, tag, value)
+                    SELECT t.id, e.tag, e.value FROM source.exif_tags e
+                    JOIN source.image_data s ON s.id = e.image_rowid
+                    JOIN main.image_data t ON t.path = s.path WHERE {taken}
+                    """)
+                res = self.cursor.execute(f"""
+                    SELECT COUNT(*) FROM main.image_data t
+                    JOIN source.image_data s ON s.path = t.path WHERE {taken}
+                    """)
+                rows = res.fetchone()[0]
+                self.cursor.execute(
+                    "INSERT OR IGNORE INTO metadata VALUES ('digest', ?)",
+                    (self.digest,),
+                )
+        finally:
+            self.cursor.execute("DETACH DATABASE source")
+        return rows
+
+    def remove_tree(self, directory):
+        """Removes the rows of all files below directory"""
+        # "0" sorts right after "/", so this is a range scan of the path index
+        with profile_stage("db_write"), self.connection:
+            res = self.connection.execute(
+                "DELETE FROM image_data WHERE path > ? AND path < ?",
+                (directory + "/", directory + "0"),
+            )
+        profile_count("rows_deleted", res.rowcount)
+        return res.rowcount
+
+    def iter_paths(self, batch_size=DB_BATCH_SIZE):
+        """Yields all indexed paths, fetching batch_size rows at a time"""
+        res = self.connection.execute("SELECT path FROM image_data")
+        while batch := res.fetchmany(batch_size):
+            for (path,) in batch:
+                yield path
+
+    def paths_under(self, directory):
+        """Returns the indexed paths of all files below directory"""
+        res = self.connection.execute(
+            "SELECT path FROM image_data WHERE path > ? AND path < ?",
+            (directory + "/", directory + "0"),
+        )
+        return [path for (path,) in res]
+
+    def select_all(self):
+        res = self.cursor.execute(f"SELECT {','.join(IMAGE_DATA_ROWS)} FROM image_data")
+        return res.fetchall()
+
+    def select_by_path(self, path):
+        res = self.cursor.execute(
+            f"SELECT {','.join(IMAGE_DATA_ROWS)} FROM image_data WHERE path = ?",
+            (abspath(path),),
+        )
+        return res.fetchall()
+
+    def path_exists(self, path):
+        res = self.cursor.execute(
+            "SELECT 1 FROM image_data WHERE path = ?", (abspath(path),)
+        )
+        return res.fetchone() is not None
+
+    def dump(self):
+        return list(map(lambda r: dict(zip(IMAGE_DATA_ROWS, r)), self.select_all()))
+
+    def iter_rows(self, batch_size=DB_BATCH_SIZE):
+        """Yields all rows as dicts, fetching batch_size rows at a time"""
+        res = self.connection.execute(
+            f"SELECT {','.join(IMAGE_DATA_ROWS)} FROM image_data"
+        )
+        while batch := res.fetchmany(batch_size):
+            for row in batch:
+                yield dict(zip(IMAGE_DATA_ROWS, row))
+
+    def duplicate_sets(self, limit=None):
+        """
+        Yields lists of rows (as dicts) that share an imagedata_checksum
+        Sets are ordered by checksum and only one set is held in memory at a time
+        """
+        res = self.connection.execute(
+            f"""
+            SELECT {','.join(IMAGE_DATA_ROWS)} FROM image_data
+            WHERE imagedata_checksum IN (
+                SELECT imagedata_checksum FROM image_data
+                WHERE imagedata_checksum IS NOT NULL
+                GROUP BY imagedata_checksum HAVING COUNT(*) > 1
+                ORDER BY imagedata_checksum LIMIT ?
+            )
+            ORDER BY imagedata_checksum, id
+            """,
+            (-1 if limit is None else limit,),
+        )
+        rows = map(lambda r: dict(zip(IMAGE_DATA_ROWS, r)), res)
+        for _, duplicate_set in groupby(rows, key=lambda r: r["imagedata_checksum"]):
+            yield list(duplicate_set)
+
+    def duplicate_stats(self):
+        """Returns the number of unique images and how many of them have duplicates"""
+        res = self.cursor.execute("""
+            SELECT COUNT(*), COALESCE(SUM(count > 1), 0) FROM (
+                SELECT COUNT(*) AS count FROM image_data
+                GROUP BY COALESCE(imagedata_checksum, id)
+            )
+            """)
+        return res.fetchone()
+
+    def migrate_exifdata(self):
+        """
+        Re-encodes exifdata stored in an older format in the current format
+        Returns the number of converted rows
+        """
+        rows = self.connection.execute(
+            "SELECT id, exifdata_encoded FROM image_data "
+            "WHERE substr(exifdata_encoded, 1, 1) != '{'"
+        )
+        converted = 0
+        while batch := rows.fetchmany(self.batch_size):
+            self.cursor.executemany(
+                "UPDATE image_data SET exifdata_encoded = ? WHERE id = ?",
+                [
+                    (encode_exifdata(decode_exifdata(encoded)), rowid)
+                    for rowid, encoded in batch
+                ],
+            )
+            self.connection.commit()
+            converted += len(batch)
+        return converted
+
+    def paths_by_tag(self, tag, value):
+        """Returns the paths of all images where tag has value"""
+        res = self.cursor.execute(
+            """
+            SELECT path FROM exif_tags
+            JOIN image_data ON image_data.id = exif_tags.image_rowid
+            WHERE tag = ? AND value = ?
+            """,
+            (tag, value),
+        )
+        paths = [row[0] for row in res]
+
+        # images without the tag have an empty value
+        if value == "":
+            res = self.cursor.execute(
+                """
+                SELECT path FROM image_data WHERE id NOT IN
+                (SELECT image_rowid FROM exif_tags WHERE tag = ?)
+                """,
+                (tag,),
+            )
+            paths.extend(row[0] for row in res)
+        return paths
+
+    def tag_value_counts(self, tag):
+        """
+        Returns a mapping of every value of tag to the number of images with it
+        Images without the tag are counted under an empty value
+        """
+        res = self.cursor.execute(
+            "SELECT value, COUNT(*) FROM exif_tags WHERE tag = ? GROUP BY value",
+            (tag,),
+        )
+        counts = dict(res.fetchall())
+
+        res = self.cursor.execute(
+            """
+            SELECT COUNT(*) FROM image_data WHERE id NOT IN
+            (SELECT image_rowid FROM exif_tags WHERE tag = ?)
+            """,
+            (tag,),
+        )
+        missing = res.fetchone()[0]
+        if missing:
+            counts[""] = counts.get("", 0) + missing
+        return counts
+
+
+def exifdata_format(encoded_string):
+    """Returns the storage format version of an encoded exifdata string"""
+    if encoded_string.startswith("{"):
+        return EXIFDATA_FORMAT_JSON
+    return EXIFDATA_FORMAT_LEGACY
+
+
+def encode_exifdata(exifdata):
+    """Encodes exifdata in the current storage format, a compact JSON object"""
+    return json_dump(exifdata, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_exifdata(encoded_string):
+    with profile_stage("exif_decode"):
+        if exifdata_format(encoded_string) == EXIFDATA_FORMAT_JSON:
+            return json_load(encoded_string)
+        from ast import literal_eval
+
+        return literal_eval(b64decode(encoded_string).decode())
+
+
+def get_exif_tag(encoded_string, tag, default=""):
+    """
+    Returns the value of a single tag from encoded exifdata
+    JSON encoded exifdata is only parsed when the tag occurs in it
+    """
+    if exifdata_format(encoded_string) == EXIFDATA_FORMAT_JSON:
+        if json_dump(tag, ensure_ascii=False) + ":" not in encoded_string:
+            return default
+    return decode_exifdata(encoded_string).get(tag, default)
+
+
+def scan_directory(directory, ordered=False):
+    """Returns the entries of a single directory, sorted by name if ordered"""
+    try:
+        with profile_stage("walk"), scandir(directory) as it:
+            entries = list(it)
+    except OSError as e:
+        logger.warning(f'Could not read directory "{directory}": {e}')
+        return iter(())
+
+    if ordered:
+        entries.sort(key=lambda entry: entry.name)
+    return iter(entries)
+
+
+def parse_shard(value):
+    """Parses a K/N shard argument into a (K, N) tuple, K counts from 1"""
+    try:
+        k, n = map(int, value.split("/"))
+    except ValueError:
+        raise ArgumentTypeError(f"Expected a shard as K/N, not {value}")
+    if not 1 <= k <= n:
+        raise ArgumentTypeError(f"Shard {k} does not exist in {n} shards")
+    return k, n
+
+
+def in_shard(path, shard):
+    """
+    Returns whether path belongs to shard, a (K, N) tuple
+    Paths are assigned by a hash of their absolute path, so every node that
+    sees the same path puts it into the same shard
+    """
+    k, n = shard
+    return int.from_bytes(md5(path.encode()).digest()[:8], "big") % n == k - 1
+
+
+def walk_files(path, extensions=MEDIA_EXTENSIONS, ordered=False):
+    """
+    Recursively yield the paths of files on path that have one of extensions
+    Extensions are matched case-insensitively and the tree is walked only once.
+    When ordered is set, files are yielded in a stable, sorted order.
+    Symbolic links to directories are not followed.
+    """
+    extensions = tuple(e.lower() for e in extensions)
+    stack = [scan_directory(abspath(path), ordered)]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(scan_directory(entry.path, ordered))
+            elif entry.name.lower().endswith(extensions) and entry.is_file():
+                yield entry.path
+        except OSError as e:
+            logger.warning(f'Could not read "{entry.path}": {e}')
+
+
+def find_images(path, ordered=False):
+    """
+    Recursively find images on the specified path
+    """
+    return walk_files(path, IMAGE_EXTENSIONS, ordered)
+
+
+def find_videos(path, ordered=False):
+    """
+    Recursively find videos on the specified path
+    """
+    return walk_files(path, VIDEO_EXTENSIONS, ordered)
+
+
+def build_image_data(path, digest=DEFAULT_DIGEST, tiered=False):
+    """
+    Parses a single file, this runs in the index worker processes
+    Returns a tuple of (path, image_data, error) so that a failing file
+    does not abort the whole index run
+    """
+    try:
+        logger.debug(f'Parsing file "{path}"')
+        return path, ImageData(path, digest, tiered), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def payload_checksum(path, column, digest=DEFAULT_DIGEST):
+    """
+    Calculates a single payload column for the tiered index mode, this runs
+    in the index worker processes. Returns a tuple of (path, value, error)
+    """
+    try:
+        if column == "payload_size":
+            return path, native_payload_size(path), None
+        if column == "partial_checksum":
+            return path, native_partial_checksum(path, digest), None
+        return path, native_imagedata_checksum(path, digest), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def index_progress():
+    """Returns the progress display of index, rich is only imported here"""
+    from rich.progress import (
+        BarColumn,
+        Progress,
+        ProgressColumn,
+        SpinnerColumn,
+        TextColumn,
+        TimeElapsedColumn,
+    )
+    from rich.text import Text
+
+    class ThroughputColumn(ProgressColumn):
+        """Renders the files/s and, from the bytes field, MB/s of a task"""
+
+        def render(self, task):
+            if not task.elapsed:
+                return Text("")
+            files = task.completed / task.elapsed
+            megabytes = task.fields.get("bytes", 0) / task.elapsed / 1e6
+            return Text(f"{files:.1f} files/s {megabytes:.1f} MB/s")
+
+    return Progress(
+        SpinnerColumn(),
+        TextColumn("{task.description}"),
+        BarColumn(),
+        TextColumn("{task.completed} files"),
+        ThroughputColumn(),
+        TimeElapsedColumn(),
+    )
+
+
+def worker_processes(jobs, initializer):
+    """
+    Returns a pool of jobs worker processes that run initializer, which
+    is passed whether profiling is on. multiprocessing is imported here
+    only, most subcommands never start worker processes.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(
+        jobs, initializer=initializer, initargs=(bool(PROFILER),)
+    )
+
+
+def init_profiler(profile=False):
+    """
+    Gives a worker process its own profiler when profiling, a forked worker
+    would otherwise start with a copy of everything the parent recorded
+    """
+    global PROFILER
+    PROFILER = Profiler() if profile else None
+
+
+def init_index_worker(profile=False):
+    """Gives every index worker process its own single exiftool process"""
+    from multiprocessing.util import Finalize
+
+    global EXIFTOOL_POOL
+    init_profiler(profile)
+    EXIFTOOL_POOL = ExifToolPool(size=1)
+    Finalize(EXIFTOOL_POOL, EXIFTOOL_POOL.close, exitpriority=10)
+
+
+def imap_ordered(executor, fn, iterable, window):
+    """
+    Like executor.map but only keeps window tasks in flight, so results
+    are returned in order while the iterable is consumed lazily
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def index_media(
+    db,
+    path,
+    force_reindex,
+    jobs=1,
+    extensions=MEDIA_EXTENSIONS,
+    ordered=False,
+    tiered=False,
+    shard=None,
+):
+    """
+    When called all files at path will be indexed into the database
+
+    Files whose stat fingerprint matches the one in the database are skipped,
+    all fingerprints are loaded once up front. Rows indexed before
+    fingerprints were stored are skipped as well and get their fingerprint
+    recorded. New and modified files are parsed by a pool of jobs worker
+    processes while the directory tree is still being walked. Results are
+    written to the database by this process only, in the same order as a
+    serial run would. Returns a list of (path, error) for failed files.
+
+    When tiered, only the payload size of natively parsable files is
+    recorded, see resolve_checksums for the checksums. With a (K, N) shard
+    only the files of that shard are indexed, see in_shard.
+    """
+    logger.info(f'Indexing files in "{path}"')
+    if any(e.lower().endswith(IMAGE_EXTENSIONS) for e in extensions):
+        pillow_available()
+    files = walk_files(path, extensions, ordered)
+    if shard:
+        logger.info(f"Indexing shard {shard[0]} of {shard[1]}")
+        files = (f for f in files if in_shard(f, shard))
+    known = {} if force_reindex else db.fingerprints()
+
+    errors = []
+    with index_progress() as progress:
+        task = progress.add_task("Indexing files...", total=None, bytes=0)
+
+        def pending_files():
+            for f in files:
+                if f not in known:
+                    yield f
+                    continue
+
+                try:
+                    fingerprint = stat_fingerprint(f)
+                except OSError:
+                    yield f
+                    continue
+
+                # skip files that have not changed since they were indexed
+                if known[f] is None:
+                    db.update_fingerprint(f, fingerprint)
+                elif known[f] != fingerprint:
+                    logger.debug(f'File "{f}" has changed')
+                    yield f
+                    continue
+
+                logger.debug(f'Skipping file "{f}"')
+                progress.advance(task)
+
+        build = partial(build_image_data, digest=db.digest, tiered=tiered)
+        if jobs > 1 and isinstance(EXIFTOOL_POOL, AsyncExifToolPool):
+            # the async engine keeps jobs exiftool calls in flight from here
+            executor = ThreadPoolExecutor(jobs)
+            results = imap_ordered(executor, build, pending_files(), jobs * 4)
+        elif jobs > 1:
+            executor = worker_processes(jobs, init_index_worker)
+            build = partial(profiled_call, build)
+            results = imap_ordered(executor, build, pending_files(), jobs * 4)
+            results = worker_results(results)
+        else:
+            executor = None
+            results = map(build, pending_files())
+
+        indexed_bytes = 0
+        try:
+            for f, image_data, error in results:
+                if error:
+                    logger.error(f'Error occurred while parsing file "{f}": {error}')
+                    errors.append((str(f), error))
+                else:
+                    logger.debug(f'Inserting file "{f}"')
+                    db.insert(image_data, upsert=True)
+                    indexed_bytes += image_data.fingerprint[0]
+                    progress.update(task, bytes=indexed_bytes)
+                progress.advance(task)
+        finally:
+            db.flush()
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
+    total = int(progress.tasks[0].completed)
+    logger.info(f"Processed {total} files")
+    if errors:
+        logger.error(f"Failed to index {len(errors)} of {total} files")
+    return errors
+
+
+def update_payload_column(db, paths, column, jobs=1):
+    """Calculates column for all paths and updates their rows"""
+    if not paths:
+        return
+
+    logger.info(f"Calculating {column} of {len(paths)} files")
+    calculate = partial(payload_checksum, column=column, digest=db.digest)
+    if jobs > 1:
+        executor = worker_processes(jobs, init_index_worker)
+        calculate = partial(profiled_call, calculate)
+        results = worker_results(imap_ordered(executor, calculate, paths, jobs * 4))
+    else:
+        executor = None
+        results = map(calculate, paths)
+
+    try:
+        for path, value, error in results:
+            if error:
+                logger.warning(f'Could not calculate {column} of "{path}": {error}')
+                continue
+            db.update(path, **{column: value})
+    finally:
+        db.flush()
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+
+def resolve_checksums(db, jobs=1, tiered=False, all_pending=False):
+    """
+    Calculates the checksums the tiered index mode skipped, where needed
+
+    Rows only get a partial checksum (start and end of the payload) when
+    another row has a payload of the same size. They only get an imagedata
+    checksum when another row also has the same partial checksum, or for all
+    rows that are missing one when all_pending is set. When tiered, rows
+    indexed before payload sizes were recorded get their payload size first,
+    so that new files are compared against them as well.
+    """
+    if tiered:
+        update_payload_column(db, db.paths_without_payload_size(), "payload_size", jobs)
+    if not all_pending:
+        paths = db.paths_needing_partial_checksum()
+        update_payload_column(db, paths, "partial_checksum", jobs)
+
+    paths = db.paths_needing_checksum(all_pending)
+    update_payload_column(db, paths, "imagedata_checksum", jobs)
+
+
+def index_videos(db, path, force_reindex=False, jobs=1):
+    """
+    When called all videos at path will be indexed into the database
+    """
+    return index_media(db, path, force_reindex, jobs, VIDEO_EXTENSIONS)
+
+
+def index(db, args):
+    exiftool_command()
+    errors = index_media(
+        db,
+        args.path,
+        args.force_reindex,
+        args.jobs,
+        args.extensions,
+        args.sorted,
+        args.tiered,
+        args.shard,
+    )
+    resolve_checksums(db, args.jobs, args.tiered)
+    if errors:
+        exit(1)
+
+
+def hash_pending(db, args):
+    """Calculate all imagedata checksums the tiered index mode skipped"""
+    resolve_checksums(db, args.jobs, all_pending=True)
+
+
+def dump(db, args):
+    """
+    Print all rows as one JSON list or, with --ndjson, one JSON object per line
+    The NDJSON output is streamed so memory use does not grow with the database
+    """
+    rows = db.iter_rows() if args.ndjson else db.dump()
+    if args.decode_exif:
+        rows = map(decode_row_exifdata, rows)
+
+    if not args.ndjson:
+        print(json_dump(list(rows)))
+        return
+
+    # sys.stdout is looked up on every call, so it can be redirected
+    for row in rows:
+        sys.stdout.write(json_dump(row) + "\n")
+    sys.stdout.flush()
+
+
+def decode_row_exifdata(row):
+    """Replaces exifdata_encoded of a row with the decoded exifdata"""
+    row["exifdata"] = decode_exifdata(row.pop("exifdata_encoded"))
+    return row
+
+
+def get_duplicate(db, args):
+    duplicate_set = next(db.duplicate_sets(limit=1), None)
+    if duplicate_set is None:
+        logger.error("No duplicates found")
+        exit(1)
+    print(json_dump(duplicate_set))
+
+
+def images_by_tag(db, args):
+    """Return list of image paths that have a matchin exiftag value"""
+    print(json_dump(db.paths_by_tag(args.tag, args.value)))
+
+
+def unique_tag_values(db, args):
+    """Returns the unique values for a tag and how many images have them"""
+    print(json_dump(db.tag_value_counts(args.tag)))
+
+
+def phash_path(path):
+    """Worker function for the phash subcommand"""
+    return path, perceptual_hash(path)
+
+
+def phash(db, args):
+    """Calculate perceptual hashes for indexed images that do not have one"""
+    paths = db.paths_without_phash()
+    logger.info(f"Calculating perceptual hashes for {len(paths)} images")
+    if paths and not pillow_available():
+        exit(1)
+
+    with worker_processes(args.jobs, init_profiler) as executor:
+        worker = partial(profiled_call, phash_path)
+        results = worker_results(imap_ordered(executor, worker, paths, args.jobs * 4))
+        for path, value in results:
+            if value is None:
+                logger.warning(f'Could not calculate perceptual hash of "{path}"')
+                continue
+            db.update_phash(path, value)
+    db.flush()
+
+
+def similar(db, args):
+    """Print pairs of images whose perceptual hashes are within --distance"""
+    hashes = list(db.phashes())
+    if not hashes:
+        logger.error(
+            "No image has a perceptual hash, install Pillow and run imgtool phash"
+        )
+        exit(1)
+
+    if args.engine == "numpy":
+        try:
+            pairs = similar_pairs_numpy(
+                hashes, args.distance, args.block_size, args.jobs
+            )
+        except ImportError:
+            logger.error("The numpy engine requires NumPy to be installed")
+            exit(1)
+    else:
+        pairs = similar_pairs(hashes, args.distance)
+    pairs.sort(key=lambda p: (p[2], p[0], p[1]))
+    print(json_dump(pairs))
+
+
+def migrate_exif(db, args):
+    """Convert exifdata of all rows to the current storage format"""
+    converted = db.migrate_exifdata()
+    print(f"Converted exif data of {converted} images")
+
+
+def fix(db, args):
+    """
+    Fix exifdata of all duplicate sets, independent sets are fixed in
+    parallel. The rows of all modified files are refreshed afterwards.
+
+    With --plan the edits are only written to a file, with --apply the
+    edits of such a file are applied. Applied edits are recorded in a
+    journal next to the plan, so an interrupted run can be resumed.
+    """
+    if args.plan:
+        write_fix_plan(db, args.plan)
+        return
+    exiftool_command()
+    if args.apply:
+        if apply_fix_plan(db, args.apply, args.jobs):
+            exit(1)
+        return
+
+    errors = []
+    paths = []
+    with ThreadPoolExecutor(args.jobs) as executor:
+        results = imap_ordered(executor, fix_set, db.duplicate_sets(), args.jobs * 4)
+        for path, fixed_paths, error in results:
+            paths.extend(fixed_paths)
+            if error:
+                logger.error(
+                    f'Error occurred while fixing the set of "{path}": {error}'
+                )
+                errors.append((path, error))
+
+    refresh_rows(db, paths, args.jobs)
+    if errors:
+        logger.error(f"Failed to fix {len(errors)} duplicate sets")
+        exit(1)
+
+
+def plan_fix_set(duplicate_set):
+    """Returns the exiftool commands that fix a single duplicate set"""
+    if duplicate_set[0]["path"].lower().endswith(VIDEO_EXTENSIONS + (".avi",)):
+        return plan_fix_videos(duplicate_set)
+    return plan_fix_images(duplicate_set)
+
+
+def write_fix_plan(db, plan_path):
+    """
+    Writes the edits for all duplicate sets to plan_path without touching
+    any files, one JSON object per line. The journal of a previous plan
+    at the same path is removed.
+    """
+    journal_path = f"{plan_path}.journal"
+    if isfile(journal_path):
+        logger.info(f'Removing the journal of the previous plan "{journal_path}"')
+        remove(journal_path)
+
+    edits = 0
+    with open(plan_path, "w") as plan:
+        for duplicate_set in db.duplicate_sets():
+            checksum = duplicate_set[0]["imagedata_checksum"]
+            for command in plan_fix_set(duplicate_set):
+                edit = {"id": edits, "set": checksum, "args": command}
+                plan.write(json_dump(edit) + "\n")
+                edits += 1
+    logger.info(f'Wrote {edits} edits to "{plan_path}"')
+
+
+def read_journal(journal_path, plan_id):
+    """
+    Returns the ids of the edits recorded in a journal. The first line of
+    a journal names the plan it belongs to, ids in the journal of another
+    plan would mark unrelated edits as applied.
+    """
+    if not isfile(journal_path):
+        return set()
+    with open(journal_path) as journal:
+        header = journal.readline().split()
+        if header != ["plan", plan_id]:
+            raise JournalMismatch(
+                f'Journal "{journal_path}" belongs to another plan, remove it to apply this plan from the start'
+            )
+        return {int(line) for line in journal if line.strip()}
+
+
+def apply_fix_plan(db, plan_path, jobs=1):
+    """
+    Applies the edits in plan_path that are not in its journal yet.
+    The edits of a duplicate set are applied in order and every applied
+    edit is recorded in the journal before the next one starts. Sets are
+    applied in parallel, a failed edit stops only its own set. Rows of
+    files that changed are refreshed after. Returns the failed sets as a
+    list of (set, error).
+    """
+    journal_path = f"{plan_path}.journal"
+
+    plan_digest = md5()
+    edits = []
+    with open(plan_path, "rb") as plan:
+        for line in plan:
+            plan_digest.update(line)
+            edits.append(json_load(line))
+    plan_id = plan_digest.hexdigest()
+    applied = read_journal(journal_path, plan_id)
+
+    pending = {}
+    paths = set()
+    for edit in edits:
+        paths.update(command_paths(edit["args"]))
+        if edit["id"] not in applied:
+            pending.setdefault(edit["set"], []).append(edit)
+
+    edits = sum(map(len, pending.values()))
+    logger.info(f"Applying {edits} edits, {len(applied)} were applied before")
+
+    errors = []
+    if pending:
+        lock = Lock()
+        with open(journal_path, "a") as journal:
+            if not applied and journal.tell() == 0:
+                journal.write(f"plan {plan_id}\n")
+
+            def apply_edits(edits):
+                for edit in edits:
+                    try:
+                        run_commands([edit["args"]])
+                    except ExifToolError as e:
+                        return edit["set"], e.message
+                    with lock:
+                        journal.write(f"{edit['id']}\n")
+                        journal.flush()
+                        fsync(journal.fileno())
+                return edit["set"], None
+
+            with ThreadPoolExecutor(jobs) as executor:
+                for checksum, error in executor.map(apply_edits, pending.values()):
+                    if error:
+                        logger.error(
+                            f'Error occurred while applying the edits of set "{checksum}": {error}'
+                        )
+                        errors.append((checksum, error))
+
+    refresh_rows(db, db.stale_paths(sorted(paths)), jobs)
+    if errors:
+        logger.error(f"Failed to apply the edits of {len(errors)} duplicate sets")
+    return errors
+
+
+def fix_set(duplicate_set):
+    """
+    Fix exifdata of a single duplicate set, returns the path of its first
+    file, the paths that were modified and the error that stopped the set.
+    The files of a failed command count as modified, it may have written
+    some of them.
+    """
+    commands = []
+    error = None
+    try:
+        for command in plan_fix_set(duplicate_set):
+            commands.append(command)
+            run_commands([command])
+    except ExifToolError as e:
+        error = e.message
+    paths = sorted({path for command in commands for path in command_paths(command)})
+    return duplicate_set[0]["path"], paths, error
+
+
+def refresh_rows(db, paths, jobs=1):
+    """Parse paths again and replace their rows in a single transaction"""
+    if not paths:
+        return
+
+    logger.info(f"Refreshing {len(paths)} modified files in the database")
+    build = partial(build_image_data, digest=db.digest)
+    with ThreadPoolExecutor(jobs) as executor:
+        image_datas = []
+        for path, image_data, error in executor.map(build, paths):
+            if error:
+                logger.error(f'Error occurred while parsing file "{path}": {error}')
+                continue
+            image_datas.append(image_data)
+
+    db.insert_many(image_datas, upsert=True)
+    db.flush()
+
+
+def command_paths(command):
+    """Returns the file arguments of an exiftool command"""
+    return [arg for arg in command if not arg.startswith("-")]
+
+
+def run_commands(commands):
+    """Run the exiftool commands of a single duplicate set in order"""
+    for command in commands:
+        print("cmd:", " ".join([exiftool_command()] + command))
+        exiftool(command)
+    return commands
+
+
+def plan_fix_videos(duplicate_set):
+    """
+    Returns the exiftool commands that fix the exifdata of a duplicate set
+    of videos, every command operates on all files of the set at once
+    """
+    EncodingTime = None
+    MediaClassPrimaryID = None
+    MediaClassSecondaryID = None
+
+    for image in duplicate_set:
+        encoded = image.get("exifdata_encoded", "")
+
+        _EncodingTime = get_exif_tag(encoded, "Encoding Time", None)
+        if _EncodingTime:
+            EncodingTime = _EncodingTime
+
+        _MediaClassPrimaryID = get_exif_tag(encoded, "Media Class Primary ID", None)
+        if _MediaClassPrimaryID:
+            MediaClassPrimaryID = _MediaClassPrimaryID
+
+        _MediaClassSecondaryID = get_exif_tag(encoded, "Media Class Secondary ID", None)
+        if _MediaClassSecondaryID:
+            MediaClassSecondaryID = _MediaClassSecondaryID
+
+    paths = [image["path"] for image in duplicate_set]
+    return [
+        # We temporaryily write to Image Description before removing it
+        # To force update the Media Data Offset field
+        [
+            "-ImageDescription=temp",
+            "-overwrite_original",
+            *paths,
+        ],
+        [
+            "-XMP:All=",  # remove all XMP data
+            "-ImageDescription=",
+            "-overwrite_original",
+            *paths,
+        ],
+        [
+            f"-EncodingTime={EncodingTime}",
+            f"-MediaClassPrimaryID={MediaClassPrimaryID}",
+            f"-MediaClassSecondaryID={MediaClassSecondaryID}",
+            "-overwrite_original",
+            *paths,
+        ],
+    ]
+
+
+def fix_videos(duplicate_set):
+    return run_commands(plan_fix_videos(duplicate_set))
+
+
+def plan_fix_images(duplicate_set):
+    """
+    Returns the exiftool commands that fix the exifdata of a duplicate set
+    of images, every command operates on all files of the set at once
+    """
+    tags = {
+        "Software": [],
+    }
+
+    for image in duplicate_set:
+        encoded = image.get("exifdata_encoded", "")
+        tags["Software"].append(get_exif_tag(encoded, "Software"))
+
+    paths = [image["path"] for image in duplicate_set]
+    commands = [
+        [
+            "-XMP:All=",  # remove all XMP data
+            "-ThumbnailImage=",  # remove thumbnails to fix incorrect thumbnail offset (can be regenerated)
+            "-OriginatingProgram=",  # remove (created by Shotwell in my specific case)
+            "-ProgramVersion=",  # remove (created by Shotwell in my specific case)
+            "-ApplicationRecordVersion=",  # don't need it
+            "-CurrentIPTCDigest=",  # don't need it
+            "-overwrite_original",
+            *paths,
+        ]
+    ]
+
+    if len(tags["Software"]) > 1:
+        _unique = list(set(tags["Software"]))
+        if len(_unique) > 1:
+            _unique_valid = [i for i in _unique if i not in INVALID_SOFTWARE_TAG_VALUES]
+            if len(_unique_valid) == 1:
+                if _unique_valid[0] == "":
+                    logger.info(f"Unique Software values: {_unique}")
+                    commands.append(
+                        [
+                            f"-Software={_unique_valid[0]}",
+                            "-overwrite_original",
+                            *paths,
+                        ]
+                    )
+
+    return commands
+
+
+def fix_images(duplicate_set):
+    """Fix exif data in duplicate sets"""
+    return run_commands(plan_fix_images(duplicate_set))
+
+
+def stats(db, args):
+    """Print statistics on duplicates"""
+    images, dupes = db.duplicate_stats()
+    print(f"Found {images} sets of images of which {dupes} have duplicates")
+
+
+def directory_files(directory):
+    """
+    Returns the names of the files in directory, an empty set if the
+    directory is gone and None if it can not be read
+    """
+    try:
+        with scandir(directory) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+    except OSError as e:
+        logger.warning(f'Skipping "{directory}": {e}')
+        return None
+
+
+def missing_paths(paths, jobs=1):
+    """
+    Returns the paths that no longer exist
+    Paths are grouped by their parent directory so each directory is only
+    listed once, directories are listed in parallel.
+    """
+    directories = {}
+    for path in paths:
+        directories.setdefault(dirname(path), []).append(path)
+
+    missing = []
+    with ThreadPoolExecutor(jobs) as executor:
+        listings = executor.map(directory_files, directories)
+        for (directory, dir_paths), names in zip(directories.items(), listings):
+            if names is None:
+                continue
+            missing.extend(p for p in dir_paths if basename(p) not in names)
+    return missing
+
+
+def merge(db, args):
+    """
+    Merge index databases, e.g. shards, into the database given with -o
+    Sources are migrated to the current schema first. All of them have to
+    use the same digest algorithm as the output database, an output without
+    rows adopts the algorithm of the first source. Checksums that tiered
+    shards skipped are calculated where rows of different sources now share
+    a payload size.
+    """
+    # opening a missing source would create an empty database
+    missing = [path for path in args.sources if not isfile(path)]
+    if missing:
+        logger.error(f"Databases not found: {', '.join(missing)}")
+        exit(1)
+
+    for source_path in args.sources:
+        source = ImageDataDB(source_path, readonly=True)
+        source_digest = source.digest
+        source.close()
+
+        if db.get_metadata("digest") is None and not args.digest:
+            db.digest = source_digest
+        if source_digest != db.digest:
+            raise DigestMismatch(
+                f'Database "{source_path}" uses {source_digest} checksums, not {db.digest}'
+            )
+
+        rows = db.merge(abspath(source_path))
+        logger.info(f'Merged {rows} rows from "{source_path}"')
+
+    # rows of tiered shards may now collide with rows of another shard
+    resolve_checksums(db, args.jobs)
+
+
+def maintenance(db, args):
+    """Run ANALYZE, a WAL checkpoint and VACUUM on the database"""
+    size = stat(db.db).st_size
+    db.maintenance(vacuum=not args.skip_vacuum)
+    logger.info(f"Database size {size} -> {stat(db.db).st_size} bytes")
+
+
+def clean(db, args):
+    """Remove the rows of files that no longer exist"""
+    missing = missing_paths(db.iter_paths(), args.jobs)
+    for path in missing:
+        logger.info(
+            f"{'Missing' if args.dry_run else 'Removing missing'} file at {path}"
+        )
+    if args.dry_run:
+        logger.info(f"{len(missing)} rows would be removed")
+        return
+    db.remove_many(missing)
+    logger.info(f"Removed {len(missing)} rows")
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+
+# struct inotify_event without the variable length name that follows it
+INOTIFY_EVENT = Struct("iIII")
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding through ctypes, it watches directory trees
+    Watch descriptors are mapped back to directory paths, so events are
+    returned as (path, mask) with the full path of the affected entry
+    """
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.poller = poll()
+        self.poller.register(self.fd, POLLIN)
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(), WATCH_MASK)
+        if wd < 0:
+            errno = self.get_errno()
+            if errno == 28:  # ENOSPC
+                logger.error(
+                    "Out of inotify watches, raise fs.inotify.max_user_watches"
+                )
+            else:
+                logger.warning(f'Could not watch "{directory}": errno {errno}')
+            return None
+        self.watches[wd] = directory
+        return wd
+
+    def watch_tree(self, directory):
+        """Watches directory and every directory below it"""
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            if self.add_watch(directory) is None:
+                continue
+            for entry in scan_directory(directory):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                except OSError:
+                    continue
+
+    def unwatch_tree(self, directory):
+        """Stops watching directory and every directory below it"""
+        prefix = directory + "/"
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout=None):
+        """
+        Waits up to timeout seconds for events and returns them as a list
+        of (path, mask). A queue overflow is returned as (None, IN_Q_OVERFLOW).
+        """
+        if not self.poller.poll(None if timeout is None else timeout * 1000):
+            return []
+        try:
+            data = os_read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = (
+                data[pos : pos + length].rstrip(b"\0").decode(errors="surrogateescape")
+            )
+            pos += length
+
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, IN_Q_OVERFLOW))
+                continue
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            events.append((f"{directory}/{name}" if name else directory, mask))
+        return events
+
+    def close(self):
+        os_close(self.fd)
+
+
+def watch_action(mask):
+    """
+    Returns what an inotify event means for the index: "index" or "remove"
+    a single file, "index_tree" or "remove_tree" for directories, or None
+    """
+    if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            return "index_tree"
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            return "remove_tree"
+        return None
+    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        return "index"
+    if mask & (IN_DELETE | IN_MOVED_FROM):
+        return "remove"
+    return None
+
+
+def apply_watch_batch(db, inotify, actions, extensions, jobs=1):
+    """
+    Applies a batch of coalesced actions, rows are removed first and all
+    new and modified files are indexed together
+    """
+    files = []
+    removed_paths = []
+    for path, action in actions.items():
+        if action == "remove":
+            removed_paths.append(path)
+        elif action == "remove_tree":
+            inotify.unwatch_tree(path)
+            db.remove_tree(path)
+        elif action == "index_tree":
+            inotify.watch_tree(path)
+            files.extend(walk_files(path, extensions))
+        elif path.lower().endswith(extensions) and isfile(path):
+            files.append(path)
+    db.remove_many(removed_paths)
+
+    # files of a new directory can also have events of their own
+    files = list(dict.fromkeys(files))
+    removed = sum(1 for action in actions.values() if action.startswith("remove"))
+    logger.info(f"Applying batch: {len(files)} files to index, {removed} removals")
+    refresh_rows(db, files, jobs)
+
+
+def rescan(db, inotify, path, extensions, jobs=1):
+    """
+    Brings the index of path up to date after events were lost. Only files
+    whose stat fingerprint changed are parsed again and only rows below
+    path are checked for files that disappeared.
+    """
+    logger.warning(f'Rescanning "{path}"')
+    inotify.unwatch_tree(path)
+    inotify.watch_tree(path)
+    index_media(db, path, False, jobs, extensions)
+    db.remove_many(missing_paths(db.paths_under(path), jobs))
+
+
+def watch(db, args):
+    """
+    Keeps the index of a directory tree up to date using inotify
+    Events are coalesced per path, a batch is applied once no event arrived
+    for --debounce seconds or the oldest event is --max-delay seconds old.
+    When the kernel event queue overflows, the tree is rescanned.
+    """
+    exiftool_command()
+    path = abspath(args.path)
+    extensions = tuple(e.lower() for e in args.extensions)
+    inotify = Inotify()
+    # leave through the finally blocks, so pending rows are written
+    signal(SIGTERM, lambda *_: exit(0))
+
+    try:
+        inotify.watch_tree(path)
+        logger.info(f'Watching {len(inotify.watches)} directories in "{path}"')
+        if args.scan:
+            rescan(db, inotify, path, extensions, args.jobs)
+
+        actions = {}
+        first_event = None
+        while True:
+            events = inotify.read(args.debounce if actions else None)
+            now = monotonic()
+            for event_path, mask in events:
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("The inotify event queue overflowed")
+                    actions = {}
+                    first_event = None
+                    rescan(db, inotify, path, extensions, args.jobs)
+                    break
+                if mask & IN_DELETE_SELF and event_path == path:
+                    logger.error(f'"{path}" was removed')
+                    return
+                action = watch_action(mask)
+                if action:
+                    # the last event for a path decides what happens to it
+                    actions.pop(event_path, None)
+                    actions[event_path] = action
+                    first_event = first_event or now
+
+            if actions and (not events or now - first_event >= args.max_delay):
+                apply_watch_batch(db, inotify, actions, extensions, args.jobs)
+                actions = {}
+                first_event = None
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        inotify.close()
+
+
+# Responses of the serve daemon up to this size are cached
+SERVE_CACHE_MAX_BYTES = 1024 * 1024
+SERVE_CACHE_ENTRIES = 256
+
+
+def server_socket_path(dbpath):
+    """Returns the path of the Unix socket the serve daemon of dbpath uses"""
+    return f"{abspath(dbpath)}.sock"
+
+
+def request_server(socket_path, request):
+    """Sends a JSON request to a serve daemon and returns its JSON response"""
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json_dump(request).encode())
+        client.shutdown(socket.SHUT_WR)
+        response = bytearray()
+        while chunk := client.recv(65536):
+            response += chunk
+    return json_load(response)
+
+
+def forward_to_server(args, command):
+    """
+    Runs a read-only subcommand on the serve daemon of the database when
+    one is running. Returns its exit status, or None when there is no
+    daemon to forward to and the subcommand has to run locally.
+    """
+    socket_path = server_socket_path(args.dbpath)
+    if not exists(socket_path):
+        return None
+    try:
+        response = request_server(socket_path, {"argv": command})
+    except (OSError, ValueError):
+        logger.debug(f'No serve daemon answers on "{socket_path}"')
+        return None
+    sys.stderr.write(response["stderr"])
+    sys.stdout.write(response["stdout"])
+    return response["status"]
+
+
+def run_served(db, command):
+    """
+    Runs a forwarded subcommand on db and returns its exit status, its
+    output and everything it logged or wrote to stderr
+    """
+    output = StringIO()
+    errors = StringIO()
+    handler = logging.StreamHandler(errors)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.getLogger().addHandler(handler)
+    try:
+        with redirect_stdout(output), redirect_stderr(errors):
+            args = parse_args(command)
+            if not args.forwardable:
+                logger.error(f"{command} can not be forwarded")
+                exit(2)
+            args.func(db, args)
+        status = 0
+    except SystemExit as e:
+        status = e.code
+    except Exception:
+        logger.exception(f"Forwarded command {command} failed")
+        status = 1
+    finally:
+        logging.getLogger().removeHandler(handler)
+    return {"status": status, "stdout": output.getvalue(), "stderr": errors.getvalue()}
+
+
+def serve(db, args):
+    """
+    Answers the read-only subcommands the CLI forwards over a Unix socket
+    The database stays open, so its page cache stays warm, and responses
+    are cached until another connection changes the database.
+    """
+    import socket
+
+    socket_path = server_socket_path(db.db)
+    if exists(socket_path):
+        try:
+            request_server(socket_path, {"argv": ["stats"]})
+            logger.error(f'A serve daemon is already listening on "{socket_path}"')
+            exit(1)
+        except OSError:
+            remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    chmod(socket_path, 0o600)
+    server.listen()
+    # leave through the finally block, so the socket is removed
+    signal(SIGTERM, lambda *_: exit(0))
+    logger.info(f'Serving "{db.db}" on "{socket_path}"')
+
+    cache = {}
+    data_version = None
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                request = bytearray()
+                while chunk := connection.recv(65536):
+                    request += chunk
+                try:
+                    command = json_load(request)["argv"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+                # data_version changes when another connection commits
+                version = db.cursor.execute("PRAGMA data_version").fetchone()[0]
+                if version != data_version or len(cache) >= SERVE_CACHE_ENTRIES:
+                    cache.clear()
+                    data_version = version
+
+                key = tuple(command)
+                response = cache.get(key) or run_served(db, command)
+                if len(response["stdout"]) <= SERVE_CACHE_MAX_BYTES:
+                    cache[key] = response
+                try:
+                    connection.sendall(json_dump(response).encode())
+                except OSError as e:
+                    logger.warning(f"Could not send response: {e}")
+    except KeyboardInterrupt:
+        logger.info("Stopped serving")
+    finally:
+        server.close()
+        remove(socket_path)
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(
+        prog="imgtool",
+        description="Tool to compare images in a directory and find duplicates while ignoring exif data",
+    )
+    parser.add_argument(
+        "-D", "--dbpath", type=str, default=f"{env['HOME']}/imgtool.sqlite"
+    )
+    parser.add_argument(
+        "--digest",
+        choices=DIGEST_ALGORITHMS,
+        help=f"Digest algorithm for image data checksums of a new database (default: {DEFAULT_DIGEST}), an existing database only accepts its own",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Write per-stage timings and counters of the run to FILE as JSON",
+    )
+    parser.add_argument(
+        "--cprofile",
+        metavar="FILE",
+        help="Write cProfile statistics of the subcommand to FILE",
+    )
+    parser.add_argument(
+        "--exiftool-engine",
+        dest="exiftool_engine",
+        choices=["pool", "async"],
+        default="pool",
+        help="How exiftool commands are run: pool of blocking processes per worker, or async from one process with -j commands in flight (default: pool)",
+    )
+    parser.add_argument(
+        "--exiftool-timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Abort exiftool commands that take longer, async engine only",
+    )
+    parser.add_argument(
+        "--no-serve",
+        action="store_true",
+        help="Run read-only subcommands locally even when a serve daemon is running",
+    )
+    parser.set_defaults(func=parser.print_usage, readonly=False, forwardable=False)
+    subparsers = parser.add_subparsers()
+
+    parser_index = subparsers.add_parser("index", help="Index image files")
+    parser_index.set_defaults(func=index)
+    parser_index.add_argument("path", help="Path to search for images (recursively)")
+    parser_index.add_argument(
+        "-f",
+        "--force-reindex",
+        action="store_true",
+        help="Force re-indexation of existing files",
+    )
+    parser_index.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_count() or 1,
+        help="Number of worker processes used to parse files (default: number of cores)",
+    )
+    parser_index.add_argument(
+        "-e",
+        "--extensions",
+        type=lambda v: tuple(f".{e.strip().lstrip('.')}" for e in v.split(",")),
+        default=MEDIA_EXTENSIONS,
+        help=f"Comma separated list of file extensions to index, case-insensitive (default: {','.join(MEDIA_EXTENSIONS)})",
+    )
+    parser_index.add_argument(
+        "--sorted",
+        action="store_true",
+        help="Walk directories in a stable, sorted order for reproducible runs",
+    )
+    parser_index.add_argument(
+        "--tiered",
+        action="store_true",
+        help="Only hash files whose payload size, then partial checksum, matches another file",
+    )
+    parser_index.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="K/N",
+        help="Only index the files of shard K of N, shards are combined with merge",
+    )
+
+    parser_hash_pending = subparsers.add_parser(
+        "hash-pending",
+        help="Calculate the image data checksums skipped by the tiered index mode",
+    )
+    parser_hash_pending.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_count() or 1,
+        help="Number of worker processes (default: number of cores)",
+    )
+    parser_hash_pending.set_defaults(func=hash_pending)
+
+    parser_dump = subparsers.add_parser("dump", help="Dump all rows in the database")
+    parser_dump.set_defaults(func=dump, readonly=True)
+    parser_dump.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Stream rows as newline-delimited JSON, one row per line",
+    )
+    parser_dump.add_argument(
+        "--decode-exif",
+        action="store_true",
+        help="Include decoded exif data instead of the encoded string",
+    )
 
     parser_unique = subparsers.add_parser(
         "unique-tag-values", help="List unique values for a specific tag"
@@ -587,7 +3423,7 @@ def parse_args():
     parser_unique.add_argument(
         "-t", "--tag", required=True, help="Exif tag you want to check"
     )
-    parser_unique.set_defaults(func=unique_tag_values)
+    parser_unique.set_defaults(func=unique_tag_values, readonly=True, forwardable=True)
 
     parser_tagvalue = subparsers.add_parser(
         "find-by-tag-value", help="List unique values for a specific tag"
@@ -598,23 +3434,176 @@ def parse_args():
     parser_tagvalue.add_argument(
         "-v", "--value", required=True, help="Value of the tag you are searching for"
     )
-    parser_tagvalue.set_defaults(func=images_by_tag)
+    parser_tagvalue.set_defaults(func=images_by_tag, readonly=True, forwardable=True)
+
+    parser_phash = subparsers.add_parser(
+        "phash", help="Calculate missing perceptual hashes of indexed images"
+    )
+    parser_phash.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_count() or 1,
+        help="Number of worker processes (default: number of cores)",
+    )
+    parser_phash.set_defaults(func=phash)
+
+    parser_similar = subparsers.add_parser(
+        "similar", help="List pairs of visually similar images"
+    )
+    parser_similar.add_argument(
+        "-d",
+        "--distance",
+        type=int,
+        default=4,
+        help="Maximum Hamming distance between perceptual hashes (default: 4)",
+    )
+    parser_similar.add_argument(
+        "-e",
+        "--engine",
+        choices=["bktree", "numpy"],
+        default="bktree",
+        help="Search with a BK-tree or with blocked, vectorized NumPy comparisons",
+    )
+    parser_similar.add_argument(
+        "--block-size",
+        type=int,
+        default=SIMILAR_BLOCK_SIZE,
+        help=f"Number of hashes per tile side for the numpy engine (default: {SIMILAR_BLOCK_SIZE})",
+    )
+    parser_similar.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_count() or 1,
+        help="Number of threads for the numpy engine (default: number of cores)",
+    )
+    parser_similar.set_defaults(func=similar, readonly=True, forwardable=True)
+
+    parser_migrate_exif = subparsers.add_parser(
+        "migrate-exif", help="Convert stored exif data to the current storage format"
+    )
+    parser_migrate_exif.set_defaults(func=migrate_exif)
 
     parser_fix = subparsers.add_parser("fix", help="Fix exifdata")
+    parser_fix.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=EXIFTOOL_POOL_SIZE,
+        help="Number of duplicate sets fixed in parallel (default: number of cores)",
+    )
+    parser_fix_mode = parser_fix.add_mutually_exclusive_group()
+    parser_fix_mode.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="Write the edits to FILE (JSON lines) without modifying any files",
+    )
+    parser_fix_mode.add_argument(
+        "--apply",
+        metavar="FILE",
+        help="Apply the edits in FILE, resuming after the last applied edit",
+    )
     parser_fix.set_defaults(func=fix)
 
     parser_stats = subparsers.add_parser("stats", help="Show duplicate stats")
-    parser_stats.set_defaults(func=stats)
+    parser_stats.set_defaults(func=stats, readonly=True, forwardable=True)
 
     parser_dupe = subparsers.add_parser("dupe", help="Get a single duplicate set")
-    parser_dupe.set_defaults(func=get_duplicate)
+    parser_dupe.set_defaults(func=get_duplicate, readonly=True, forwardable=True)
 
-    parser_stats = subparsers.add_parser(
+    parser_clean = subparsers.add_parser(
         "clean", help="Clean up missing files from database"
     )
-    parser_stats.set_defaults(func=clean)
+    parser_clean.set_defaults(func=clean)
+    parser_clean.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=16,
+        help="Number of directories listed in parallel (default: 16)",
+    )
+    parser_clean.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Only count the rows of missing files, do not remove them",
+    )
+
+    parser_watch = subparsers.add_parser(
+        "watch", help="Keep the index of a directory up to date using inotify"
+    )
+    parser_watch.set_defaults(func=watch)
+    parser_watch.add_argument("path", help="Path to watch (recursively)")
+    parser_watch.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of files of a batch parsed in parallel (default: 1)",
+    )
+    parser_watch.add_argument(
+        "-e",
+        "--extensions",
+        type=lambda v: tuple(f".{e.strip().lstrip('.')}" for e in v.split(",")),
+        default=MEDIA_EXTENSIONS,
+        help=f"Comma separated list of file extensions to index, case-insensitive (default: {','.join(MEDIA_EXTENSIONS)})",
+    )
+    parser_watch.add_argument(
+        "--debounce",
+        type=float,
+        default=2.0,
+        help="Seconds without events before a batch is applied (default: 2)",
+    )
+    parser_watch.add_argument(
+        "--max-delay",
+        type=float,
+        default=30.0,
+        help="Seconds after which a batch is applied even if events keep coming (default: 30)",
+    )
+    parser_watch.add_argument(
+        "--scan",
+        action="store_true",
+        help="Bring the index up to date with a rescan before watching",
+    )
+
+    parser_merge = subparsers.add_parser(
+        "merge", help="Merge index databases, e.g. shards, into one"
+    )
+    parser_merge.set_defaults(func=merge)
+    parser_merge.add_argument("sources", nargs="+", help="Databases to merge")
+    parser_merge.add_argument(
+        "-o",
+        "--output",
+        dest="dbpath",
+        required=True,
+        help="Database to merge into, it is created when it does not exist",
+    )
+    parser_merge.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of files hashed in parallel for skipped checksums (default: 1)",
+    )
+
+    parser_serve = subparsers.add_parser(
+        "serve",
+        help="Answer read-only subcommands from a resident process, the CLI forwards them to it",
+    )
+    parser_serve.set_defaults(func=serve, readonly=True)
+
+    parser_maintenance = subparsers.add_parser(
+        "maintenance", help="Analyze, checkpoint and vacuum the database"
+    )
+    parser_maintenance.set_defaults(func=maintenance)
+    parser_maintenance.add_argument(
+        "--skip-vacuum",
+        action="store_true",
+        help="Do not rebuild the database file, VACUUM blocks all other writers",
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.func == parser.print_usage:
         parser.print_usage()
@@ -627,11 +3616,57 @@ def main():
     logger.debug("Parsing command-line arguments")
     args = parse_args()
 
+    profiling = args.profile or args.cprofile
+    if args.forwardable and not (args.no_serve or profiling):
+        status = forward_to_server(args, argv[1:])
+        if status is not None:
+            exit(status)
+
     logger.debug('Initializing database client"')
-    db = ImageDataDB(args.dbpath)
+    try:
+        db = ImageDataDB(args.dbpath, digest=args.digest, readonly=args.readonly)
+    except DigestMismatch as e:
+        logger.error(e.message)
+        exit(1)
+
+    if args.exiftool_engine == "async":
+        use_async_exiftool(getattr(args, "jobs", None), args.exiftool_timeout)
+
+    global PROFILER
+    if args.profile:
+        PROFILER = Profiler()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
 
     logger.debug("Calling subcommand function")
-    args.func(db, args)
+    try:
+        if profiler:
+            profiler.runcall(args.func, db, args)
+        else:
+            args.func(db, args)
+    except (DigestMismatch, ExifToolMissing, JournalMismatch) as e:
+        logger.error(e.message)
+        exit(1)
+    finally:
+        db.close()
+        if profiler:
+            profiler.dump_stats(args.cprofile)
+        if PROFILER:
+            write_profile(args.profile)
+
+
+def write_profile(path):
+    """Writes the profiler report, exiftool processes are stopped first"""
+    # CPU time of child processes is only known once they have been waited for
+    if EXIFTOOL_POOL:
+        EXIFTOOL_POOL.close()
+    report = {"command": argv[1:], **PROFILER.report()}
+    with open(path, "w") as f:
+        f.write(json_dump(report, indent=2) + "\n")
+    logger.info(f'Wrote profile to "{path}"')
 
 
 if __name__ == "__main__":
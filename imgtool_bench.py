@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for imgtool.py
+#
+# exif-decode: compares decoding the legacy exifdata storage format
+#              (base64 encoded repr of a dict) with the JSON format
+# corpus:      generates a synthetic JPEG/MP4 corpus with duplicates
+# pipeline:    times imgtool subcommands on a synthetic corpus, using
+#              imgtool_fake_exiftool.py so runs are deterministic, and
+#              compares the results with a stored baseline
+
+import random
+
+from argparse import ArgumentParser
+from base64 import b64encode
+from json import dumps as json_dump
+from json import loads as json_load
+from os import environ, makedirs, remove
+from os.path import abspath, dirname, isfile, join
+from shutil import copyfile, rmtree
+from statistics import median
+from subprocess import DEVNULL, run
+from sys import executable, exit, stderr
+from tempfile import mkdtemp
+from time import perf_counter
+
+HERE = dirname(abspath(__file__))
+IMGTOOL = join(HERE, "imgtool.py")
+FAKE_EXIFTOOL = join(HERE, "imgtool_fake_exiftool.py")
+
+# Files per directory of a generated corpus
+CORPUS_DIR_SIZE = 100
+
+
+def synthetic_exifdata(rng, tags):
+    """Returns an exifdata dict that looks like parsed exiftool output"""
+    exifdata = {
+        f"Tag Name {i:03d}": f"{rng.random() * 1000:.4f} value" for i in range(tags)
+    }
+    exifdata["Software"] = rng.choice(["Picasa", "Google", "A536BXXS4AVJ1"])
+    return dict(sorted(exifdata.items()))
+
+
+def throughput(fn, items, repeat):
+    """Returns the best number of items per second processed by fn"""
+    best = 0
+    for _ in range(repeat):
+        start = perf_counter()
+        for item in items:
+            fn(item)
+        best = max(best, len(items) / (perf_counter() - start))
+    return best
+
+
+def bench_exif_decode(args):
+    # imgtool is only imported here, the pipeline runs it as a subprocess
+    from imgtool import decode_exifdata, encode_exifdata, get_exif_tag
+
+    rng = random.Random(args.seed)
+    rows = [synthetic_exifdata(rng, args.tags) for _ in range(args.rows)]
+    legacy = [b64encode(str(row).encode()).decode() for row in rows]
+    current = [encode_exifdata(row) for row in rows]
+
+    results = {
+        "rows": args.rows,
+        "tags": args.tags,
+        "legacy_bytes": sum(map(len, legacy)),
+        "json_bytes": sum(map(len, current)),
+        "legacy_decode_rows_per_s": throughput(decode_exifdata, legacy, args.repeat),
+        "json_decode_rows_per_s": throughput(decode_exifdata, current, args.repeat),
+        "legacy_single_tag_rows_per_s": throughput(
+            lambda e: get_exif_tag(e, "Software"), legacy, args.repeat
+        ),
+        "json_single_tag_rows_per_s": throughput(
+            lambda e: get_exif_tag(e, "Software"), current, args.repeat
+        ),
+    }
+    results["decode_speedup"] = (
+        results["json_decode_rows_per_s"] / results["legacy_decode_rows_per_s"]
+    )
+    print(json_dump(results, indent=2))
+
+
+def segment(marker, data):
+    """Returns a JPEG marker segment"""
+    return bytes([0xFF, marker]) + (len(data) + 2).to_bytes(2, "big") + data
+
+
+def box(box_type, data):
+    """Returns an ISOBMFF box"""
+    return (len(data) + 8).to_bytes(4, "big") + box_type + data
+
+
+def synthetic_jpeg(payload, comment):
+    """
+    Returns a JPEG file structure around payload, the comment ends up in the
+    Exif APP1 segment so files that only differ in it are duplicates
+    """
+    return b"".join(
+        [
+            b"\xff\xd8",
+            segment(0xE1, b"Exif\x00\x00" + comment),
+            segment(0xDB, b"\x00" + bytes(range(1, 65))),
+            segment(0xC0, b"\x08\x00\x10\x00\x10\x01\x01\x11\x00"),
+            segment(0xDA, b"\x01\x01\x00\x00\x3f\x00"),
+            payload,
+            b"\xff\xd9",
+        ]
+    )
+
+
+def synthetic_mp4(payload, comment):
+    """Returns an MP4 file with the comment in moov/udta and payload in mdat"""
+    return b"".join(
+        [
+            box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2mp41"),
+            box(b"moov", box(b"mvhd", bytes(100)) + box(b"udta", comment)),
+            box(b"mdat", payload),
+        ]
+    )
+
+
+def generate_corpus(path, files, size, duplicate_ratio, video_ratio, seed):
+    """
+    Writes files synthetic JPEG and MP4 files of about size bytes to path
+    A duplicate_ratio share of them reuses the payload of an earlier file
+    with different metadata. Returns the paths of the written files.
+    """
+    rng = random.Random(seed)
+    originals = []
+    paths = []
+    for i in range(files):
+        if originals and rng.random() < duplicate_ratio:
+            payload, video = rng.choice(originals)
+        else:
+            length = max(1, int(rng.uniform(0.5, 1.5) * size))
+            # without 0xff bytes the payload never contains a JPEG marker
+            payload = rng.randbytes(length).replace(b"\xff", b"\x00")
+            video = rng.random() < video_ratio
+            originals.append((payload, video))
+
+        comment = f"synthetic file {i} {rng.random()}".encode()
+        directory = join(path, f"dir{i // CORPUS_DIR_SIZE:04d}")
+        makedirs(directory, exist_ok=True)
+        if video:
+            file_path = join(directory, f"VID_{i:06d}.mp4")
+            data = synthetic_mp4(payload, comment)
+        else:
+            file_path = join(directory, f"IMG_{i:06d}.jpg")
+            data = synthetic_jpeg(payload, comment)
+        with open(file_path, "wb") as f:
+            f.write(data)
+        paths.append(file_path)
+    return paths
+
+
+def bench_corpus(args):
+    paths = generate_corpus(
+        args.path,
+        args.files,
+        args.size,
+        args.duplicate_ratio,
+        args.video_ratio,
+        args.seed,
+    )
+    print(f"Wrote {len(paths)} files to {args.path}")
+
+
+def remove_db(db_path):
+    """Removes a database together with its WAL files"""
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if isfile(path):
+            remove(path)
+
+
+def imgtool_command(db_path, *args):
+    """Returns a function that runs imgtool with the fake exiftool"""
+    env = dict(environ, IMGTOOL_EXIFTOOL=FAKE_EXIFTOOL)
+    command = [executable, IMGTOOL, "-D", db_path, *args]
+
+    def run_imgtool():
+        run(command, env=env, stdout=DEVNULL, stderr=DEVNULL, check=True)
+
+    return run_imgtool
+
+
+def timings(fn, setup, repeat):
+    """Returns the wall time of repeat calls of fn, setup runs untimed before each"""
+    times = []
+    for _ in range(repeat):
+        setup()
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+    return times
+
+
+def pipeline_scenarios(args, corpus, paths, db_path):
+    """
+    Returns (name, command, setup) for all pipeline scenarios, in the order
+    they have to run in. Every scenario except index needs an indexed
+    database, clean needs files that disappeared after indexing.
+    """
+    jobs = str(args.jobs)
+    index = imgtool_command(db_path, "index", "-j", jobs, corpus)
+    snapshot = f"{db_path}.clean"
+
+    def ensure_indexed():
+        if not isfile(db_path):
+            index()
+
+    def prepare_clean():
+        if not isfile(snapshot):
+            ensure_indexed()
+            rng = random.Random(args.seed)
+            for path in rng.sample(paths, int(len(paths) * args.missing_ratio)):
+                remove(path)
+            imgtool_command(db_path, "maintenance", "--skip-vacuum")()
+            copyfile(db_path, snapshot)
+        remove_db(db_path)
+        copyfile(snapshot, db_path)
+
+    return [
+        ("index", index, lambda: remove_db(db_path)),
+        ("reindex", index, ensure_indexed),
+        ("stats", imgtool_command(db_path, "stats"), ensure_indexed),
+        (
+            "find-by-tag-value",
+            imgtool_command(db_path, "find-by-tag-value", "-t", "Make", "-v", "Fake"),
+            ensure_indexed,
+        ),
+        ("fix", imgtool_command(db_path, "fix", "-j", jobs), ensure_indexed),
+        ("clean", imgtool_command(db_path, "clean"), prepare_clean),
+    ]
+
+
+def compare_baseline(results, baseline, threshold):
+    """
+    Prints the ratio of every scenario's best time to the baseline
+    Returns the names of the scenarios that are more than threshold slower
+    """
+    regressions = []
+    for name, result in results["scenarios"].items():
+        reference = baseline.get("scenarios", {}).get(name)
+        if not reference:
+            continue
+        ratio = result["best_s"] / reference["best_s"]
+        status = "REGRESSION" if ratio > 1 + threshold else "ok"
+        print(f"{name:<20} {ratio:6.2f}x baseline  {status}", file=stderr)
+        if status != "ok":
+            regressions.append(name)
+    return regressions
+
+
+def bench_pipeline(args):
+    workdir = args.workdir or mkdtemp(prefix="imgtool_bench_")
+    corpus = join(workdir, "corpus")
+    db_path = join(workdir, "bench.sqlite")
+    rmtree(corpus, ignore_errors=True)
+    remove_db(db_path)
+    remove_db(f"{db_path}.clean")
+
+    try:
+        paths = generate_corpus(
+            corpus,
+            args.files,
+            args.size,
+            args.duplicate_ratio,
+            args.video_ratio,
+            args.seed,
+        )
+        results = {
+            "corpus": {
+                "files": args.files,
+                "size": args.size,
+                "duplicate_ratio": args.duplicate_ratio,
+                "video_ratio": args.video_ratio,
+                "seed": args.seed,
+            },
+            "jobs": args.jobs,
+            "repeat": args.repeat,
+            "scenarios": {},
+        }
+        for name, fn, setup in pipeline_scenarios(args, corpus, paths, db_path):
+            if args.scenarios and name not in args.scenarios:
+                continue
+            times = timings(fn, setup, args.repeat)
+            results["scenarios"][name] = {
+                "best_s": min(times),
+                "median_s": median(times),
+                "files_per_s": args.files / min(times),
+            }
+    finally:
+        if not args.workdir:
+            rmtree(workdir, ignore_errors=True)
+
+    print(json_dump(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json_dump(results, indent=2) + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json_load(f.read())
+        if baseline.get("corpus") != results["corpus"]:
+            print("Warning: the baseline used a different corpus", file=stderr)
+        if compare_baseline(results, baseline, args.threshold):
+            exit(1)
+
+
+def add_corpus_arguments(parser):
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument(
+        "--size", type=int, default=256 * 1024, help="Average file size in bytes"
+    )
+    parser.add_argument(
+        "--duplicate-ratio",
+        type=float,
+        default=0.2,
+        help="Share of files that duplicate the payload of another file",
+    )
+    parser.add_argument(
+        "--video-ratio", type=float, default=0.1, help="Share of MP4 files"
+    )
+
+
+def parse_args():
+    parser = ArgumentParser(prog="imgtool_bench", description="Benchmarks for imgtool")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.set_defaults(func=None)
+    subparsers = parser.add_subparsers()
+
+    parser_exif = subparsers.add_parser(
+        "exif-decode", help="Compare exifdata storage format decode throughput"
+    )
+    parser_exif.add_argument("--rows", type=int, default=5000)
+    parser_exif.add_argument("--tags", type=int, default=120)
+    parser_exif.set_defaults(func=bench_exif_decode)
+
+    parser_corpus = subparsers.add_parser(
+        "corpus", help="Generate a synthetic JPEG/MP4 corpus"
+    )
+    parser_corpus.add_argument("path", help="Directory to write the corpus to")
+    add_corpus_arguments(parser_corpus)
+    parser_corpus.set_defaults(func=bench_corpus)
+
+    parser_pipeline = subparsers.add_parser(
+        "pipeline", help="Time imgtool subcommands on a synthetic corpus"
+    )
+    add_corpus_arguments(parser_pipeline)
+    parser_pipeline.add_argument("-j", "--jobs", type=int, default=1)
+    parser_pipeline.add_argument(
+        "--missing-ratio",
+        type=float,
+        default=0.05,
+        help="Share of files removed before the clean scenario",
+    )
+    parser_pipeline.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=["index", "reindex", "stats", "find-by-tag-value", "fix", "clean"],
+        help="Only run these scenarios (default: all)",
+    )
+    parser_pipeline.add_argument(
+        "--workdir", help="Keep the corpus and database in this directory"
+    )
+    parser_pipeline.add_argument("-o", "--output", help="Write the results to a file")
+    parser_pipeline.add_argument(
+        "--baseline", help="Compare the results with a stored results file"
+    )
+    parser_pipeline.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Slowdown relative to the baseline that counts as a regression",
+    )
+    parser_pipeline.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    if args.func is None:
+        parser.print_usage()
+        exit(1)
+    return args
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#
+# Deterministic stand-in for exiftool, used by imgtool_bench.py
+#
+# Point imgtool at it with IMGTOOL_EXIFTOOL=/path/to/imgtool_fake_exiftool.py
+# It speaks the "-stay_open True -@ -" protocol and understands the three
+# kinds of commands imgtool sends:
+#
+#   reading tags:      prints "Tag : Value" lines derived from the file contents
+#   stripping (-all=): writes the file without APPn/COM segments and without
+#                      trailers to stdout, like the native JPEG walker
+#   writing (-Tag=):   reports the files as updated and touches them
+
+import re
+import zlib
+
+from os import utime
+from os.path import basename, getsize, isfile
+from sys import argv, stdin, stdout
+
+# Number of synthetic tags printed per file, real exiftool prints about as many
+FAKE_TAGS = 80
+
+SOFTWARE_VALUES = ["Picasa", "Google", "A536BXXS4AVJ1", ""]
+
+# Markers that end entropy-coded data, see JPEG_MARKER in imgtool.py
+JPEG_MARKER = re.compile(rb"\xff[\x01-\xcf\xd8-\xfe]")
+
+
+def read_tags(path):
+    """Returns the tags of a file, they only depend on its first bytes"""
+    with open(path, "rb") as f:
+        crc = zlib.crc32(f.read(4096))
+
+    tags = {
+        "File Name": basename(path),
+        "File Size": f"{getsize(path)} bytes",
+        "Make": "Fake",
+        "Model": f"Model {crc % 7}",
+        "Software": SOFTWARE_VALUES[crc % len(SOFTWARE_VALUES)],
+    }
+    for i in range(FAKE_TAGS - len(tags)):
+        tags[f"Tag Name {i:03d}"] = f"{(crc >> (i % 24)) % 1000} value"
+    return "".join(f"{k:<32}: {v}\n" for k, v in tags.items() if v)
+
+
+def strip_jpeg(data):
+    """
+    Returns data without APPn and COM segments, except Adobe APP14, and
+    without anything after the EOI marker, the same bytes imgtool's native
+    JPEG walker hashes
+    """
+    out = bytearray(data[:2])
+    pos = 2
+    while pos + 2 <= len(data):
+        marker = data[pos + 1]
+        if marker == 0xD9:
+            out += data[pos : pos + 2]
+            break
+        end = pos + 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+        if marker == 0xDA:
+            # the entropy-coded data runs up to the next marker that is not RSTn
+            match = JPEG_MARKER.search(data, end)
+            end = match.start() if match else len(data)
+            out += data[pos:end]
+            pos = end
+            continue
+        is_adobe = marker == 0xEE and data[pos + 4 : pos + 9] == b"Adobe"
+        if not (0xE0 <= marker <= 0xEF or marker == 0xFE) or is_adobe:
+            out += data[pos:end]
+        pos = end
+    return bytes(out)
+
+
+def run(args):
+    """Runs a single command and writes its output to stdout"""
+    paths = [a for a in args if not a.startswith("-") and isfile(a)]
+    if not paths:
+        stdout.buffer.write(b"Error: File not found\n")
+        return
+
+    if "-all=" in args and "-o" in args:
+        with open(paths[0], "rb") as f:
+            data = f.read()
+        stdout.buffer.write(strip_jpeg(data) if data[:2] == b"\xff\xd8" else data)
+    elif any(a.startswith("-") and a.endswith("=") or "=" in a for a in args):
+        for path in paths:
+            utime(path)
+        stdout.buffer.write(b"    %d image files updated\n" % len(paths))
+    else:
+        stdout.buffer.write(read_tags(paths[0]).encode())
+
+
+def stay_open():
+    """Reads commands from stdin, one argument per line"""
+    args = []
+    for line in stdin:
+        line = line.rstrip("\n")
+        if line.startswith("-execute"):
+            run(args)
+            args = []
+            stdout.buffer.write(b"{ready%s}\n" % line[len("-execute") :].encode())
+            stdout.flush()
+        elif line == "-stay_open":
+            continue
+        elif line == "False":
+            break
+        else:
+            args.append(line)
+
+
+def main():
+    if argv[1:3] == ["-stay_open", "True"]:
+        stay_open()
+    else:
+        run(argv[1:])
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import sys
+
+from os.path import dirname
+
+# imgtool is a single module in the repository root
+sys.path.insert(0, dirname(dirname(__file__)))
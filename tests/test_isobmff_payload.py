@@ -0,0 +1,156 @@
+"""
+Synthetic MP4 and HEIC files for the native ISOBMFF parser
+
+The files are put together box by box, so every test knows which bytes
+are media payload. A metadata edit rewrites the metadata and moves the
+payload, the checksum has to stay the same.
+"""
+
+import pytest
+
+import imgtool
+
+IMAGE = b"hvc1 coded image data"
+TILE_A = b"first extent of a tile"
+TILE_B = b"second extent"
+GRID = b"grid description"
+
+
+def u16(value):
+    return value.to_bytes(2, "big")
+
+
+def u32(value):
+    return value.to_bytes(4, "big")
+
+
+def box(box_type, payload):
+    return u32(8 + len(payload)) + box_type + payload
+
+
+def full_box(box_type, version, payload):
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def ftyp(brand):
+    return box(b"ftyp", brand + u32(0) + brand)
+
+
+def infe(item_id, item_type):
+    return full_box(b"infe", 2, u16(item_id) + u16(0) + item_type + b"\0")
+
+
+def iloc(version, items, base_offset_size=0):
+    """items are (item_id, construction_method, base_offset, extents)"""
+    payload = bytes([0x44, base_offset_size << 4]) + u16(len(items))
+    for item_id, construction_method, base_offset, extents in items:
+        payload += u16(item_id)
+        if version in (1, 2):
+            payload += u16(construction_method)
+        payload += u16(0)  # data_reference_index
+        payload += base_offset.to_bytes(base_offset_size, "big")
+        payload += u16(len(extents))
+        for offset, length in extents:
+            payload += u32(offset) + u32(length)
+    return full_box(b"iloc", version, payload)
+
+
+def heic(exif, version=0, idat=False):
+    """
+    Returns a HEIC file and the payload bytes it should hash. The mdat box
+    holds the Exif item first, so its size moves every image extent.
+    """
+    item_types = [(1, b"hvc1"), (2, b"Exif"), (3, b"hvc1")]
+    if idat:
+        item_types.append((4, b"grid"))
+    entries = b"".join(infe(item_id, item_type) for item_id, item_type in item_types)
+    iinf = full_box(b"iinf", 0, u16(len(item_types)) + entries)
+    head = ftyp(b"heic")
+
+    def meta(mdat_start):
+        # with iloc version 1 the extent offsets are relative to a base offset
+        base_offset_size = 4 if version else 0
+        base = mdat_start if version else 0
+        origin = 0 if version else mdat_start
+        tile = origin + len(exif) + len(IMAGE)
+        items = [
+            (1, 0, base, [(origin + len(exif), len(IMAGE))]),
+            (2, 0, base, [(origin, len(exif))]),
+            (3, 0, base, [(tile, len(TILE_A)), (tile + len(TILE_A), len(TILE_B))]),
+        ]
+        if idat:
+            items.append((4, 1, 0, [(4, len(GRID))]))
+        children = iinf + iloc(version, items, base_offset_size)
+        if idat:
+            children += box(b"idat", b"skip" + GRID)
+        return full_box(b"meta", 0, children)
+
+    mdat_start = len(head) + len(meta(0)) + 8
+    mdat = box(b"mdat", exif + IMAGE + TILE_A + TILE_B)
+    payload = IMAGE + TILE_A + TILE_B + (GRID if idat else b"")
+    return head + meta(mdat_start) + mdat, payload
+
+
+def mp4(metadata, large_mdat=False):
+    """Returns an MP4 file with its metadata in moov/udta and the payload"""
+    media = b"avc1 samples " * 8
+    moov = box(b"moov", box(b"mvhd", bytes(20)) + box(b"udta", metadata))
+    if large_mdat:
+        mdat = u32(1) + b"mdat" + (16 + len(media)).to_bytes(8, "big") + media
+    else:
+        mdat = box(b"mdat", media)
+    return ftyp(b"isom") + moov + mdat, media
+
+
+def payload(data):
+    return b"".join(
+        data[start:end] for start, end in imgtool.isobmff_payload_ranges(data)
+    )
+
+
+def checksum(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return imgtool.native_imagedata_checksum(str(path), "md5")
+
+
+@pytest.mark.parametrize("large_mdat", [False, True])
+def test_mp4_payload(large_mdat):
+    data, media = mp4(b"\xa9nam title", large_mdat)
+    assert payload(data) == media
+
+
+def test_mp4_checksum_survives_metadata_edit(tmp_path):
+    before, _ = mp4(b"\xa9nam title")
+    after, _ = mp4(b"\xa9nam a much longer title \xa9day 2024")
+    assert checksum(tmp_path, "before.mp4", before) == checksum(
+        tmp_path, "after.mp4", after
+    )
+
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_heic_payload_skips_exif_item(version):
+    data, expected = heic(b"Exif\0\0MM", version)
+    assert payload(data) == expected
+
+
+def test_heic_idat_item():
+    data, expected = heic(b"Exif\0\0MM", version=1, idat=True)
+    assert payload(data) == expected
+
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_heic_checksum_survives_metadata_edit(tmp_path, version):
+    before, _ = heic(b"Exif\0\0MM", version)
+    after, _ = heic(b"Exif\0\0MM with a rewritten IFD0 and GPS", version)
+    assert before != after
+    assert checksum(tmp_path, "before.heic", before) == checksum(
+        tmp_path, "after.heic", after
+    )
+
+
+def test_heic_unsupported_construction_method():
+    item = (1, 2, 0, [(0, 4)])
+    meta = full_box(b"meta", 0, iloc(1, [item]))
+    with pytest.raises(imgtool.UnsupportedFormat):
+        imgtool.isobmff_payload_ranges(ftyp(b"heic") + meta)
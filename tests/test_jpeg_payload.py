@@ -0,0 +1,96 @@
+"""
+Reference JPEGs for the native JPEG walker
+
+The files in tests/data were written with Pillow 12.3:
+
+  plain.jpg        baseline with JFIF, Exif, an ICC profile and a comment
+  progressive.jpg  progressive with Exif, ten scans
+  adobe_cmyk.jpg   CMYK with an Adobe APP14 segment and Exif
+  mpf_trailer.jpg  two-frame MPO, the second frame follows the first EOI
+
+The expected digests are the ones the walker produced when the files were
+added. test_matches_exiftool checks them against "exiftool -all= -o - -b"
+and only runs where a real exiftool is installed.
+"""
+
+import subprocess
+
+from hashlib import md5
+from os.path import dirname, getsize, join
+from shutil import which
+
+import pytest
+
+import imgtool
+import imgtool_fake_exiftool
+
+DATA = join(dirname(__file__), "data")
+
+# file name: (kept ranges, md5 of the kept bytes)
+REFERENCE_JPEGS = {
+    "plain.jpg": ([(0, 2), (709, 1605)], "10f38ae1205309d3235524b289f248aa"),
+    "progressive.jpg": ([(0, 2), (82, 881)], "675b9dba6fddc6a23ec05a7a34a56e04"),
+    "adobe_cmyk.jpg": ([(0, 18), (80, 945)], "3accfb44064d7bde73f8f44d0b440c09"),
+    "mpf_trailer.jpg": ([(0, 2), (188, 1093)], "044806fa85dc04bc987791b69d5a0834"),
+}
+
+
+def read(name):
+    with open(join(DATA, name), "rb") as f:
+        return f.read()
+
+
+def markers(data):
+    """Returns the markers of the segments in data, up to the first scan"""
+    found = []
+    pos = 2
+    while data[pos + 1] != 0xDA:
+        found.append(data[pos + 1])
+        pos += 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+    return found
+
+
+@pytest.mark.parametrize("name", REFERENCE_JPEGS)
+def test_payload_ranges(name):
+    ranges, _ = REFERENCE_JPEGS[name]
+    assert imgtool.jpeg_payload_ranges(read(name)) == ranges
+
+
+@pytest.mark.parametrize("name", REFERENCE_JPEGS)
+def test_checksum(name):
+    _, checksum = REFERENCE_JPEGS[name]
+    assert imgtool.native_imagedata_checksum(join(DATA, name), "md5") == checksum
+
+
+@pytest.mark.parametrize("name", REFERENCE_JPEGS)
+def test_only_adobe_app14_is_kept(name):
+    data = read(name)
+    kept = b"".join(data[start:end] for start, end in imgtool.jpeg_payload_ranges(data))
+    app_markers = [m for m in markers(kept) if 0xE0 <= m <= 0xEF or m == 0xFE]
+    assert app_markers == ([0xEE] if name == "adobe_cmyk.jpg" else [])
+    assert kept.endswith(b"\xff\xd9")
+
+
+def test_trailer_is_dropped():
+    ranges, _ = REFERENCE_JPEGS["mpf_trailer.jpg"]
+    # the second frame of the MPO starts right after the first EOI
+    assert ranges[-1][1] < getsize(join(DATA, "mpf_trailer.jpg"))
+    assert read("mpf_trailer.jpg")[ranges[-1][1] :].startswith(b"\xff\xd8")
+
+
+@pytest.mark.parametrize("name", REFERENCE_JPEGS)
+def test_fake_exiftool_strips_the_same(name):
+    _, checksum = REFERENCE_JPEGS[name]
+    assert md5(imgtool_fake_exiftool.strip_jpeg(read(name))).hexdigest() == checksum
+
+
+@pytest.mark.skipif(not which("exiftool"), reason="exiftool is not installed")
+@pytest.mark.parametrize("name", REFERENCE_JPEGS)
+def test_matches_exiftool(name):
+    _, checksum = REFERENCE_JPEGS[name]
+    output = subprocess.run(
+        [which("exiftool"), join(DATA, name), "-all=", "-o", "-", "-b"],
+        capture_output=True,
+        check=True,
+    ).stdout
+    assert md5(output).hexdigest() == checksum